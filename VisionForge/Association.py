@@ -0,0 +1,175 @@
+from collections import defaultdict
+import numpy as np
+
+
+def pairwise_iou(boxes_a, boxes_b):
+    """
+    Calculate the IoU of pairs of bounding boxes.
+    :param boxes_a: The first boxes of the pairs (K x 4, x_min, y_min, x_max, y_max).
+    :param boxes_b: The second boxes of the pairs (K x 4).
+    :return: The IoU of each pair (K).
+    """
+    width = np.clip(np.minimum(boxes_a[:, 2], boxes_b[:, 2]) - np.maximum(boxes_a[:, 0], boxes_b[:, 0]), 0, None)
+    height = np.clip(np.minimum(boxes_a[:, 3], boxes_b[:, 3]) - np.maximum(boxes_a[:, 1], boxes_b[:, 1]), 0, None)
+    intersection = width * height
+
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a + area_b - intersection
+
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def pairwise_containment(inner, outer):
+    """
+    Check whether the inner box of each pair is inside its outer box.
+    :param inner: The inner boxes of the pairs (K x 4).
+    :param outer: The outer boxes of the pairs (K x 4).
+    :return: Boolean array (K).
+    """
+    return (inner[:, 0] >= outer[:, 0]) & (inner[:, 1] >= outer[:, 1]) & \
+        (inner[:, 2] <= outer[:, 2]) & (inner[:, 3] <= outer[:, 3])
+
+
+class SpatialGrid:
+    def __init__(self, boxes, cell_size):
+        """
+        Initialize the SpatialGrid object, a uniform grid index over bounding boxes.
+        :param boxes: The indexed boxes (N x 4).
+        :param cell_size: The side of a grid cell, in pixels.
+        """
+        self.cell_size = max(int(cell_size), 1)
+        self.__cells = defaultdict(list)
+
+        cells = np.floor_divide(np.asarray(boxes, dtype=np.int64), self.cell_size)
+
+        for index, (x_min, y_min, x_max, y_max) in enumerate(cells.tolist()):
+            for cell_x in range(x_min, x_max + 1):
+                for cell_y in range(y_min, y_max + 1):
+                    self.__cells[(cell_x, cell_y)].append(index)
+
+    def query_points(self, points):
+        """
+        Find the indexed boxes that may contain each point.
+        :param points: The query points (M x 2).
+        :return: Tuple containing the point indexes and the box indexes of the candidate pairs.
+        """
+        cells = np.floor_divide(np.asarray(points, dtype=np.int64), self.cell_size)
+
+        point_indexes = []
+        box_indexes = []
+
+        for point_index, cell in enumerate(map(tuple, cells.tolist())):
+            indexes = self.__cells.get(cell, ())
+            point_indexes.extend([point_index] * len(indexes))
+            box_indexes.extend(indexes)
+
+        return np.asarray(point_indexes, dtype=np.int64), np.asarray(box_indexes, dtype=np.int64)
+
+
+class Association:
+    def __init__(self, vf: 'Tracking'):
+        self.__visionForge = vf
+
+    def __call__(self, detections, tracks):
+        """
+        Associate the YOLO detections with the tracked boxes. A detection can only be associated with a track when it
+        is inside the larger template of the track; among those, the pairs with the highest IoU win.
+        :param detections: The detected boxes (M x 4).
+        :param tracks: The list of tracked box dictionaries.
+        :return: List (M) with the associated track dictionary, or None, of each detection.
+        """
+        detections = np.asarray(detections, dtype=np.float64).reshape(-1, 4)
+        matches = [None] * len(detections)
+
+        if not len(detections) or not tracks:
+            return matches
+
+        track_cords = np.array([track['cords'] for track in tracks], dtype=np.float64).reshape(-1, 4)
+        larger_cords = np.array([self.__visionForge.generate_cords_large_template(cords) for cords in track_cords],
+                                dtype=np.float64).reshape(-1, 4)
+
+        detection_indexes, track_indexes = self.__candidates(detections, larger_cords)
+
+        gate = pairwise_containment(detections[detection_indexes], larger_cords[track_indexes])
+        detection_indexes, track_indexes = detection_indexes[gate], track_indexes[gate]
+
+        if not len(detection_indexes):
+            return matches
+
+        # Pairs that are only contained (IoU 0) are still valid, with the lowest priority.
+        scores = pairwise_iou(detections[detection_indexes], track_cords[track_indexes]) + 1e-6
+
+        if self.__visionForge.association_method == "hungarian":
+            assignment = self.__hungarian(detection_indexes, track_indexes, scores, len(detections), len(tracks))
+        elif self.__visionForge.association_method == "greedy":
+            assignment = self.__greedy(detection_indexes, track_indexes, scores)
+        else:
+            raise ValueError(f"Unknown association method: {self.__visionForge.association_method!r}")
+
+        for detection_index, track_index in assignment:
+            matches[detection_index] = tracks[track_index]
+
+        return matches
+
+    def __candidates(self, detections, larger_cords):
+        """
+        List the (detection, track) pairs worth testing. Small problems are tested exhaustively; large ones go through
+        a SpatialGrid of the larger templates, queried with the detection centers.
+        :param detections: The detected boxes (M x 4).
+        :param larger_cords: The larger templates of the tracks (N x 4).
+        :return: Tuple containing the detection indexes and the track indexes of the pairs.
+        """
+        if len(detections) * len(larger_cords) <= self.__visionForge.association_grid_threshold:
+            detection_indexes, track_indexes = np.indices((len(detections), len(larger_cords)))
+            return detection_indexes.ravel(), track_indexes.ravel()
+
+        cell_size = np.median(np.maximum(larger_cords[:, 2] - larger_cords[:, 0],
+                                         larger_cords[:, 3] - larger_cords[:, 1]))
+        grid = SpatialGrid(larger_cords, cell_size)
+
+        centers = np.stack([(detections[:, 0] + detections[:, 2]) / 2, (detections[:, 1] + detections[:, 3]) / 2],
+                           axis=1)
+
+        return grid.query_points(centers)
+
+    @staticmethod
+    def __greedy(detection_indexes, track_indexes, scores):
+        """
+        Assign the pairs by decreasing score, each detection and each track at most once. Ties keep the detection
+        order, so the assignment does not depend on the order of the tracks dictionary.
+        :return: List of (detection index, track index).
+        """
+        order = np.lexsort((track_indexes, detection_indexes, -scores))
+
+        used_detections = set()
+        used_tracks = set()
+        assignment = []
+
+        for detection_index, track_index in zip(detection_indexes[order].tolist(), track_indexes[order].tolist()):
+            if detection_index in used_detections or track_index in used_tracks:
+                continue
+
+            used_detections.add(detection_index)
+            used_tracks.add(track_index)
+            assignment.append((detection_index, track_index))
+
+        return assignment
+
+    @staticmethod
+    def __hungarian(detection_indexes, track_indexes, scores, detections_count, tracks_count):
+        """
+        Assign the pairs maximizing the total score (requires scipy).
+        :return: List of (detection index, track index).
+        """
+        try:
+            from scipy.optimize import linear_sum_assignment
+        except ImportError as e:
+            raise ImportError("association_method 'hungarian' requires scipy (pip install scipy)") from e
+
+        score_matrix = np.zeros((detections_count, tracks_count))
+        score_matrix[detection_indexes, track_indexes] = scores
+
+        rows, cols = linear_sum_assignment(score_matrix, maximize=True)
+
+        return [(row, col) for row, col in zip(rows.tolist(), cols.tolist()) if score_matrix[row, col] > 0]
@@ -0,0 +1,173 @@
+import threading
+import time
+from collections import deque
+from .Detectors import as_detector
+
+
+class BatchDetectionScheduler:
+    def __init__(self, model, max_batch_size: int = 8, max_wait_ms: float = 10):
+        """
+        Initialize the BatchDetectionScheduler object. It collects the last frame of every Tracking that shares the
+        detector and runs one batched detection per cycle, splitting the results back to each Tracking. A Tracking
+        joins a batch once its detection_period (yolo_period) since the start of its previous cycle is over.
+        :param model: The Detector (see Detectors) or YOLO model shared by the Tracking objects.
+        :param max_batch_size: The maximum number of frames in one predict.
+        :param max_wait_ms: The maximum time, in milliseconds, to wait for the batch to fill once the first frame is
+                            pending.
+        """
+        self.detector = as_detector(model)
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+        self.__active = set()
+        self.__pending = deque()
+        self.__detected = set()
+        self.__next_cycle = {}
+
+        self.__condition = threading.Condition()
+        self.__thread_yolo = threading.Thread(target=self.start_detection_thread, daemon=True)
+        self.__thread_yolo_stop_flag = False
+
+    def notify_frame(self, tracking):
+        """
+        Schedule a detection for a Tracking that published a new frame. Trackings that were never detected go first,
+        so that their first predict is not blocked behind the others.
+        :param tracking: The Tracking object.
+        """
+        with self.__condition:
+            if not self.__thread_yolo.is_alive() and not self.__thread_yolo_stop_flag:
+                # A thread runs only once: a finished one is replaced.
+                if self.__thread_yolo.ident is not None:
+                    self.__thread_yolo = threading.Thread(target=self.start_detection_thread, daemon=True)
+
+                self.__thread_yolo.start()
+
+            self.__active.add(tracking)
+
+            if tracking not in self.__pending:
+                if tracking in self.__detected:
+                    self.__pending.append(tracking)
+                else:
+                    self.__pending.appendleft(tracking)
+
+                self.__condition.notify()
+
+    def discard(self, tracking):
+        """
+        Stop scheduling detections for a Tracking. Its pending detection is discarded.
+        :param tracking: The Tracking object.
+        """
+        with self.__condition:
+            self.__active.discard(tracking)
+            self.__detected.discard(tracking)
+            self.__next_cycle.pop(tracking, None)
+
+            if tracking in self.__pending:
+                self.__pending.remove(tracking)
+
+    def __due(self):
+        """
+        :return: The pending Trackings whose detection period is over, in order, and the time the next one is due (None
+                 when there is no pending Tracking left to wait for).
+        """
+        now = time.perf_counter()
+        due = [tracking for tracking in self.__pending if self.__next_cycle.get(tracking, 0) <= now]
+        waiting = [self.__next_cycle[tracking] - now for tracking in self.__pending if tracking not in due]
+
+        return due, min(waiting, default=None)
+
+    def __next_batch(self):
+        """
+        Wait for pending frames whose detection period is over and pop the next batch of Trackings.
+        :return: List of Tracking objects, empty when the scheduler is stopped.
+        """
+        with self.__condition:
+            due, timeout = self.__due()
+
+            while not due and not self.__thread_yolo_stop_flag:
+                self.__condition.wait(timeout)
+                due, timeout = self.__due()
+
+            deadline = time.perf_counter() + self.max_wait_ms / 1000
+
+            while not self.__thread_yolo_stop_flag and len(due) < min(self.max_batch_size, len(self.__active)):
+                remaining = deadline - time.perf_counter()
+
+                if remaining <= 0:
+                    break
+
+                self.__condition.wait(remaining)
+                due, _ = self.__due()
+
+            if self.__thread_yolo_stop_flag:
+                return []
+
+            batch = due[:self.max_batch_size]
+
+            for tracking in batch:
+                self.__pending.remove(tracking)
+
+            return batch
+
+    def start_detection_thread(self):
+        """
+        Run the batched detections until the scheduler is stopped.
+        """
+        while True:
+            trackings = self.__next_batch()
+
+            if not trackings:
+                break
+
+            start = time.perf_counter()
+            slots = [tracking.frame_pool.acquire_latest() for tracking in trackings]
+            confidence = min(tracking.yolo_confidence for tracking in trackings)
+
+            try:
+                try:
+                    detections = self.detector.detect([slot.frame for slot in slots], confidence)
+                    detector_latency = time.perf_counter() - start
+                except Exception as error:
+                    # A failed batch is reported to its Trackings, whose next predict raises it; the others go on.
+                    for tracking in trackings:
+                        tracking.detection_failed(error)
+                    detections = []
+
+                for tracking, slot, frame_detections in zip(trackings, slots, detections):
+                    try:
+                        # The batched detection counts in the yolo_latency (and detector_cycle) of every Tracking.
+                        tracking.run_detection(slot.frame, frame_detections, slot.sequence,
+                                               detector_latency=detector_latency)
+                    except Exception as error:
+                        tracking.detection_failed(error)
+            finally:
+                for tracking, slot in zip(trackings, slots):
+                    tracking.frame_pool.release(slot)
+
+            with self.__condition:
+                for tracking in trackings:
+                    if tracking in self.__active:
+                        self.__detected.add(tracking)
+                        self.__next_cycle[tracking] = start + tracking.detection_period()
+
+    def is_alive(self):
+        """
+        Check whether the detection thread runs or will be started by the next notify_frame.
+        :return: False once the scheduler is stopped or its thread has died (the next notify_frame starts a new one).
+        """
+        with self.__condition:
+            if self.__thread_yolo_stop_flag:
+                return False
+
+            return self.__thread_yolo.is_alive() or self.__thread_yolo.ident is None
+
+    def stop(self):
+        """
+        Stop the detection thread.
+        """
+        with self.__condition:
+            self.__thread_yolo_stop_flag = True
+            self.__condition.notify_all()
+
+        if self.__thread_yolo.is_alive():
+            self.__thread_yolo.join()
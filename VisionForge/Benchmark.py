@@ -0,0 +1,241 @@
+"""
+Tracking benchmark on synthetic videos, CPU only and without YOLO.
+
+    python -m VisionForge.Benchmark --boxes 1 10 30 --expansions 50 100 --resolutions 640x360 1280x720
+
+Every configuration tracks a synthetic video of textured objects moving over a textured background. A stub detector,
+which finds the objects by differencing against the known background and sleeps --detector-latency-ms to emulate the
+YOLO cost, replaces the model. The frames are fed at --source-fps (like a camera; 0 feeds them as fast as possible,
+which makes the detections much staler than in a real stream). The tracker FPS (1 / mean predict time), the p50/p99
+predict latency and the per-stage timings of Instrumentation are reported for each configuration.
+
+    python -m VisionForge.Benchmark --boxes 10 --log run.vflog
+    python -m VisionForge.Benchmark --boxes 10 --replay run.vflog
+
+--log records the run in a track log (see TrackLog); --replay tracks the same video with the logged detections instead
+of the stub detector, so tracker-only changes are measured on exactly the same detections.
+"""
+import argparse
+import itertools
+import json
+import time
+import cv2
+import numpy as np
+from .Tracking import Tracking
+from .Detectors import Detector
+from .Instrumentation import Instrumentation
+from .TrackLog import TrackLogWriter
+
+
+class SyntheticVideo:
+    def __init__(self, width: int = 1280, height: int = 720, boxes: int = 10, box_size: int = 48, speed: float = 4.0,
+                 seed: int = 0):
+        """
+        Initialize the SyntheticVideo object: textured objects moving at constant velocity, bouncing on the frame
+        borders, over a static textured background.
+        :param width: The width of the frames.
+        :param height: The height of the frames.
+        :param boxes: The number of moving objects.
+        :param box_size: The side of the objects, in pixels.
+        :param speed: The maximum speed of the objects, in pixels per frame.
+        :param seed: The random seed.
+        """
+        rng = np.random.default_rng(seed)
+
+        self.width = width
+        self.height = height
+        self.box_size = box_size
+
+        self.background = cv2.GaussianBlur((rng.random((height, width, 3)) * 120).astype(np.uint8), (0, 0), 3)
+        self.textures = [cv2.GaussianBlur((rng.random((box_size, box_size, 3)) * 255).astype(np.uint8), (0, 0), 2)
+                         for _ in range(boxes)]
+
+        self.__positions = rng.uniform([0, 0], [width - box_size, height - box_size], (boxes, 2))
+        self.__velocities = rng.uniform(-speed, speed, (boxes, 2))
+
+    def frames(self, count):
+        """
+        Generate the frames of the video.
+        :param count: The number of frames.
+        """
+        limits = np.array([self.width - self.box_size, self.height - self.box_size], dtype=np.float64)
+
+        for _ in range(count):
+            frame = self.background.copy()
+
+            for (x, y), texture in zip(self.__positions.astype(int).tolist(), self.textures):
+                frame[y: y + self.box_size, x: x + self.box_size] = texture
+
+            yield frame
+
+            self.__positions += self.__velocities
+            bounced = (self.__positions < 0) | (self.__positions > limits)
+            self.__velocities[bounced] *= -1
+            self.__positions = np.clip(self.__positions, 0, limits)
+
+
+class StubDetector(Detector):
+    def __init__(self, background, latency_ms: float = 50.0):
+        """
+        Initialize the StubDetector object, a stand-in for YOLO implementing the Detector protocol. It finds the
+        objects of a SyntheticVideo by differencing against its background.
+        :param background: The background of the SyntheticVideo.
+        :param latency_ms: The time each detection sleeps, to emulate the YOLO cost.
+        """
+        self.background = background
+        self.latency_ms = latency_ms
+        self.names = {0: 'object'}
+
+    def detect(self, frames, confidence):
+        time.sleep(self.latency_ms / 1000)
+
+        detections = []
+
+        for frame in frames:
+            mask = (cv2.absdiff(frame, self.background).max(axis=2) > 0).astype(np.uint8)
+            _, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+
+            xyxy = np.array([[x, y, x + w, y + h] for x, y, w, h, _ in stats[1:].tolist()],
+                            dtype=np.float32).reshape(-1, 4)
+            detections.append((xyxy, np.full(len(xyxy), 0.9, dtype=np.float32), np.zeros(len(xyxy), dtype=np.int32)))
+
+        return detections
+
+
+def run_benchmark(boxes=10, expansion=100, resolution=(1280, 720), method="TM_CCORR_NORMED", frames=150,
+                  warmup=10, detector_latency_ms=50.0, box_size=48, source_fps=30.0, seed=0, speed=4.0, track_log=None,
+                  replay=None, **settings):
+    """
+    Track one synthetic video and measure it.
+    :param boxes: The number of moving objects.
+    :param expansion: The horizontal_expansion and vertical_expansion of the Tracking.
+    :param resolution: The (width, height) of the video.
+    :param method: The name of the OpenCV template matching method (e.g. "TM_CCORR_NORMED").
+    :param frames: The number of measured frames.
+    :param warmup: The number of frames tracked before measuring.
+    :param detector_latency_ms: The latency of the stub detector.
+    :param box_size: The side of the objects, in pixels.
+    :param source_fps: The rate at which the frames are fed to the Tracking. 0 feeds them as fast as possible.
+    :param seed: The random seed of the video.
+    :param speed: The maximum speed of the objects, in pixels per frame (0 for a static scene).
+    :param track_log: The path of a track log recording the run.
+    :param replay: The path of a track log of the same configuration, whose detections replace the stub detector.
+    :param settings: Other Tracking attributes to set (e.g. adaptive_search=True).
+    :return: Dictionary with the configuration, 'fps', 'p50_ms', 'p99_ms', 'tracked' (mean results per frame),
+             'skipped' (mean boxes carried forward by change_gating per frame) and 'stages' (Instrumentation summary).
+    """
+    width, height = resolution
+    video = SyntheticVideo(width, height, boxes, box_size, speed, seed)
+
+    if replay is None:
+        vf = Tracking(model=StubDetector(video.background, detector_latency_ms))
+    else:
+        vf = Tracking(None)
+
+    vf.horizontal_expansion = expansion
+    vf.vertical_expansion = expansion
+    vf.template_matching_method = getattr(cv2, method)
+
+    for name, value in settings.items():
+        setattr(vf, name, value)
+
+    instrumentation = Instrumentation()
+    tracked = 0
+    frame_interval = 1 / source_fps if source_fps else 0.
+    next_frame = time.perf_counter()
+
+    if track_log is not None:
+        vf.track_log = TrackLogWriter(track_log)
+
+    def paced(source):
+        # Instrumentation starts with the first measured frame, before it is tracked.
+        nonlocal next_frame
+
+        for index, frame in enumerate(source):
+            if index == warmup:
+                vf.instrumentation = instrumentation
+
+            next_frame += frame_interval
+            yield frame
+            time.sleep(max(0., next_frame - time.perf_counter()))
+
+    source = paced(video.frames(warmup + frames))
+
+    try:
+        for index, results in enumerate(vf.replay(source, replay) if replay is not None else map(vf.predict, source)):
+            if index >= warmup:
+                tracked += len(results)
+    finally:
+        vf.close()
+
+        if vf.track_log is not None:
+            vf.track_log.close()
+
+    summary = instrumentation.summary()
+    latencies = instrumentation.samples('predict')
+
+    return {
+        'boxes': boxes,
+        'expansion': expansion,
+        'resolution': f"{width}x{height}",
+        'method': method,
+        'fps': float(len(latencies) / latencies.sum()) if len(latencies) else 0.,
+        'p50_ms': summary['predict']['p50'] * 1000,
+        'p99_ms': summary['predict']['p99'] * 1000,
+        'tracked': tracked / frames,
+        'skipped': summary.get('skipped', {}).get('mean', 0.),
+        'stages': summary,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="VisionForge Tracking benchmark on synthetic videos (CPU, no YOLO).")
+    parser.add_argument('--boxes', type=int, nargs='+', default=[1, 10, 30])
+    parser.add_argument('--expansions', type=int, nargs='+', default=[100])
+    parser.add_argument('--resolutions', nargs='+', default=['1280x720'])
+    parser.add_argument('--methods', nargs='+', default=['TM_CCORR_NORMED'])
+    parser.add_argument('--frames', type=int, default=150)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--box-size', type=int, default=48)
+    parser.add_argument('--detector-latency-ms', type=float, default=50.)
+    parser.add_argument('--source-fps', type=float, default=30.)
+    parser.add_argument('--speed', type=float, default=4., help="Maximum object speed in pixels per frame.")
+    parser.add_argument('--change-gating', action='store_true', help="Enable Tracking.change_gating.")
+    parser.add_argument('--log', help="Record the run in this track log (a single configuration).")
+    parser.add_argument('--replay', help="Replay the detections of this track log (a single configuration).")
+    parser.add_argument('--json', help="Write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    if (args.log or args.replay) and len(args.boxes) * len(args.expansions) * len(args.resolutions) * len(
+            args.methods) > 1:
+        parser.error("--log and --replay take a single configuration")
+
+    resolutions = [tuple(int(value) for value in resolution.lower().split('x')) for resolution in args.resolutions]
+
+    print(f"{'boxes':>5} {'expansion':>9} {'resolution':>10} {'method':>16} {'fps':>8} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'match ms':>8} {'tracked':>7} {'skipped':>7}")
+
+    reports = []
+
+    for boxes, expansion, resolution, method in itertools.product(args.boxes, args.expansions, resolutions,
+                                                                  args.methods):
+        report = run_benchmark(boxes, expansion, resolution, method, args.frames, args.warmup,
+                               args.detector_latency_ms, args.box_size, args.source_fps, speed=args.speed,
+                               track_log=args.log, replay=args.replay, change_gating=args.change_gating)
+        reports.append(report)
+
+        match_ms = report['stages'].get('match_template', {}).get('p50', 0.) * 1000
+
+        print(f"{report['boxes']:>5} {report['expansion']:>9} {report['resolution']:>10} {report['method']:>16} "
+              f"{report['fps']:>8.1f} {report['p50_ms']:>8.2f} {report['p99_ms']:>8.2f} {match_ms:>8.3f} "
+              f"{report['tracked']:>7.1f} {report['skipped']:>7.1f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fh:
+            json.dump(reports, fh, indent=2)
+
+    return reports
+
+
+if __name__ == '__main__':
+    main()
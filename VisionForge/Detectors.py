@@ -0,0 +1,300 @@
+import ast
+import importlib.util
+from pathlib import Path
+from typing import Union
+import cv2
+import numpy as np
+
+
+class Detector:
+    """
+    Protocol of the detectors consumed by YOLOProcessing. A detector has a 'names' dictionary {class id: label} and a
+    detect(frames, confidence) method returning, per frame, a tuple with the boxes (N x 4 float32, x_min, y_min, x_max,
+    y_max, in frame pixels), the confidences (N float32) and the class ids (N int32).
+    """
+    names = {}
+    input_size = None
+
+    def detect(self, frames, confidence):
+        """
+        Detect the objects of a batch of frames.
+        :param frames: List of BGR frames.
+        :param confidence: The minimum confidence of the detections.
+        :return: List with one (xyxy, confidences, class_ids) tuple per frame.
+        """
+        raise NotImplementedError
+
+    def warmup(self, runs: int = 1):
+        """
+        Run the detector on blank frames, so that the first real detection does not pay the lazy initializations
+        (memory allocation, kernel selection, graph optimization).
+        :param runs: The number of warm-up detections.
+        """
+        width, height = self.input_size or (640, 640)
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+
+        for _ in range(runs):
+            self.detect([frame], 1.0)
+
+    def close(self):
+        """
+        Release the resources of the detector.
+        """
+
+    @staticmethod
+    def empty_detections():
+        """
+        :return: The (xyxy, confidences, class_ids) tuple of a frame without detections.
+        """
+        return (np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int32))
+
+
+class UltralyticsDetector(Detector):
+    def __init__(self, model_path: Union[str, Path] = "yolov8n.pt", model=None, input_size=None):
+        """
+        Initialize the UltralyticsDetector object, which runs an ultralytics YOLO model (torch is imported only here).
+        :param model_path: The path to the YOLO model.
+        :type model_path: str or Path
+        :param model: An already loaded model with the ultralytics predict interface. When given, model_path is not
+                      loaded.
+        :param input_size: The (width, height) the frames are resized to. When None, ultralytics picks it.
+        """
+        self.model = model if model is not None else self.load_model(model_path)
+        self.input_size = input_size
+
+    @property
+    def names(self):
+        return self.model.names
+
+    @staticmethod
+    def load_model(model_path):
+        """
+        Load the YOLO model on the best available device.
+        :param model_path: The path to the YOLO model.
+        :return: The loaded YOLO model.
+        """
+        import torch
+        from ultralytics import YOLO
+
+        model = YOLO(str(model_path).strip())
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        model.to(device)
+
+        return model
+
+    @staticmethod
+    def result_to_arrays(result):
+        """
+        Convert a YOLO result into compact arrays.
+        :param result: The YOLO result of one frame.
+        :return: Tuple containing the boxes (N x 4), the confidences (N) and the class ids (N).
+        """
+        boxes = result.boxes
+
+        return (boxes.xyxy.cpu().numpy().astype(np.float32).reshape(-1, 4),
+                boxes.conf.cpu().numpy().astype(np.float32).reshape(-1),
+                boxes.cls.cpu().numpy().astype(np.int32).reshape(-1))
+
+    def detect(self, frames, confidence):
+        kwargs = {'conf': confidence, 'verbose': False}
+
+        if self.input_size is not None:
+            kwargs['imgsz'] = [self.input_size[1], self.input_size[0]]
+
+        return [self.result_to_arrays(result) for result in self.model.predict(list(frames), **kwargs)]
+
+
+class ExportedYOLODetector(Detector):
+    def __init__(self, input_size=(640, 640), names=None, iou_threshold: float = 0.45):
+        """
+        Initialize the ExportedYOLODetector object, the pre/post-processing shared by the backends of exported (ONNX)
+        YOLOv8 models: letterbox to a fixed input size, decoding of the (4 + classes) x anchors output and per class
+        Non-Maximum Suppression.
+        :param input_size: The fixed (width, height) of the model input.
+        :param names: The labels {class id: label}. When None, the class ids are used as labels.
+        :param iou_threshold: The IoU above which overlapping boxes of the same class are suppressed.
+        """
+        self.input_size = tuple(input_size)
+        self.names = dict(names) if names else {}
+        self.iou_threshold = iou_threshold
+
+        self.__blob = np.empty((1, 3, self.input_size[1], self.input_size[0]), dtype=np.float32)
+
+    def infer(self, blob):
+        """
+        Run the model.
+        :param blob: The 1 x 3 x height x width float32 input (RGB, 0-1).
+        :return: The raw output of the model.
+        """
+        raise NotImplementedError
+
+    def detect(self, frames, confidence):
+        return [self.__detect_frame(frame, confidence) for frame in frames]
+
+    def __detect_frame(self, frame, confidence):
+        """
+        Detect the objects of one frame.
+        """
+        scale, pad_x, pad_y = self.__letterbox(frame)
+        output = np.asarray(self.infer(self.__blob))[0]
+
+        # (4 + classes) x anchors; some exporters transpose it.
+        if output.shape[0] > output.shape[1]:
+            output = output.T
+
+        if not self.names:
+            self.names = {class_id: str(class_id) for class_id in range(output.shape[0] - 4)}
+
+        scores = output[4:]
+        class_ids = scores.argmax(axis=0)
+        confidences = scores[class_ids, np.arange(scores.shape[1])]
+
+        keep = confidences >= confidence
+        cx, cy, w, h = output[:4, keep]
+        class_ids, confidences = class_ids[keep].astype(np.int32), confidences[keep].astype(np.float32)
+
+        xyxy = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+        xyxy = (xyxy - [pad_x, pad_y, pad_x, pad_y]) / scale
+        xyxy = np.clip(xyxy, 0, [frame.shape[1], frame.shape[0], frame.shape[1], frame.shape[0]]).astype(np.float32)
+
+        if not len(xyxy):
+            return self.empty_detections()
+
+        # Per class NMS with a single call: the boxes of each class are shifted to their own region.
+        offsets = class_ids[:, None].astype(np.float32) * (max(frame.shape[:2]) + 1)
+        shifted = xyxy + offsets
+        indices = cv2.dnn.NMSBoxes(np.concatenate([shifted[:, :2], shifted[:, 2:] - shifted[:, :2]], axis=1).tolist(),
+                                   confidences.tolist(), confidence, self.iou_threshold)
+        indices = np.array(indices, dtype=np.int64).reshape(-1)
+
+        return xyxy[indices], confidences[indices], class_ids[indices]
+
+    def __letterbox(self, frame):
+        """
+        Resize the frame into the fixed input size keeping its aspect ratio, pad it and write it to the input blob.
+        :return: Tuple containing the scale and the horizontal and vertical padding.
+        """
+        width, height = self.input_size
+        scale = min(width / frame.shape[1], height / frame.shape[0])
+        new_width, new_height = round(frame.shape[1] * scale), round(frame.shape[0] * scale)
+        pad_x, pad_y = (width - new_width) // 2, (height - new_height) // 2
+
+        canvas = np.full((height, width, 3), 114, dtype=np.uint8)
+        canvas[pad_y: pad_y + new_height, pad_x: pad_x + new_width] = cv2.resize(frame, (new_width, new_height),
+                                                                                   interpolation=cv2.INTER_LINEAR)
+
+        np.multiply(canvas[..., ::-1].transpose(2, 0, 1), 1 / 255, out=self.__blob[0], casting='unsafe')
+
+        return scale, pad_x, pad_y
+
+
+class OnnxRuntimeDetector(ExportedYOLODetector):
+    def __init__(self, model_path: Union[str, Path], input_size=None, names=None, iou_threshold: float = 0.45,
+                 providers=None, threads: int = 0):
+        """
+        Initialize the OnnxRuntimeDetector object, which runs an exported YOLOv8 ONNX model on ONNX Runtime (imported
+        only here), without torch.
+        :param model_path: The path to the ONNX model.
+        :type model_path: str or Path
+        :param input_size: The (width, height) of the model input. When None, it is read from the model, or 640 x 640
+                           for models exported with a dynamic size.
+        :param names: The labels {class id: label}. When None, they are read from the ultralytics metadata of the model.
+        :param iou_threshold: The IoU of the Non-Maximum Suppression.
+        :param providers: The ONNX Runtime execution providers. When None, the CPU provider.
+        :param threads: The number of intra-op threads (0 lets ONNX Runtime decide).
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+
+        self.session = onnxruntime.InferenceSession(str(model_path).strip(), options,
+                                                    providers=providers or ['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.__input_name = model_input.name
+
+        if input_size is None:
+            height, width = model_input.shape[2:4]
+            input_size = (width, height) if isinstance(width, int) and isinstance(height, int) else (640, 640)
+
+        if names is None:
+            metadata = self.session.get_modelmeta().custom_metadata_map.get('names')
+            names = ast.literal_eval(metadata) if metadata else None
+
+        super().__init__(input_size, names, iou_threshold)
+
+    def infer(self, blob):
+        return self.session.run(None, {self.__input_name: blob})[0]
+
+
+class OpenCVDNNDetector(ExportedYOLODetector):
+    def __init__(self, model_path: Union[str, Path], input_size=(640, 640), names=None, iou_threshold: float = 0.45):
+        """
+        Initialize the OpenCVDNNDetector object, which runs an exported YOLOv8 ONNX model on the OpenCV DNN module, with
+        no dependency besides OpenCV.
+        :param model_path: The path to the ONNX model.
+        :type model_path: str or Path
+        :param input_size: The fixed (width, height) the model was exported with.
+        :param names: The labels {class id: label}. When None, the class ids are used as labels.
+        :param iou_threshold: The IoU of the Non-Maximum Suppression.
+        """
+        self.net = cv2.dnn.readNet(str(model_path).strip())
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+        super().__init__(input_size or (640, 640), names, iou_threshold)
+
+    def infer(self, blob):
+        self.net.setInput(blob)
+        return self.net.forward()
+
+
+BACKENDS = ("auto", "ultralytics", "onnxruntime", "opencv")
+
+
+def load_detector(model_path: Union[str, Path], backend: str = "auto", input_size=None, warmup: bool = True):
+    """
+    Load a detector.
+    :param model_path: The path to the model.
+    :type model_path: str or Path
+    :param backend: "ultralytics", "onnxruntime", "opencv" (cv2.dnn) or "auto": ONNX models run on ONNX Runtime when
+                    it is installed and on cv2.dnn otherwise; any other model on ultralytics.
+    :param input_size: The fixed (width, height) of the model input (None for the backend default).
+    :param warmup: Run a warm-up detection before returning.
+    :return: The Detector.
+    """
+    model_path = str(model_path).strip()
+
+    if backend == "auto":
+        if Path(model_path).suffix.lower() != '.onnx':
+            backend = "ultralytics"
+        elif importlib.util.find_spec('onnxruntime') is not None:
+            backend = "onnxruntime"
+        else:
+            backend = "opencv"
+
+    if backend == "ultralytics":
+        detector = UltralyticsDetector(model_path, input_size=input_size)
+    elif backend == "onnxruntime":
+        detector = OnnxRuntimeDetector(model_path, input_size=input_size)
+    elif backend == "opencv":
+        detector = OpenCVDNNDetector(model_path, input_size=input_size)
+    else:
+        raise ValueError(f"Unknown detector backend: {backend!r}")
+
+    if warmup:
+        detector.warmup()
+
+    return detector
+
+
+def as_detector(model):
+    """
+    Wrap a model into the Detector protocol.
+    :param model: A Detector, or a model with the ultralytics predict interface (e.g. an already loaded YOLO).
+    :return: The Detector.
+    """
+    if hasattr(model, 'detect'):
+        return model
+
+    return UltralyticsDetector(model=model)
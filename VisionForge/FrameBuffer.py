@@ -0,0 +1,102 @@
+import threading
+import numpy as np
+
+
+class FrameSlot:
+    __slots__ = ('frame', 'sequence', 'references')
+
+    def __init__(self, shape, dtype):
+        """
+        Initialize the FrameSlot object, one preallocated frame of a FrameBufferPool.
+        :param shape: The shape of the frame.
+        :param dtype: The dtype of the frame.
+        """
+        self.frame = np.empty(shape, dtype=dtype)
+        self.sequence = 0
+        self.references = 0
+
+
+class FrameBufferPool:
+    def __init__(self, slots: int = 3):
+        """
+        Initialize the FrameBufferPool object: a ring of preallocated frames, with reference counting, used to hand the
+        frames from the tracker to the detector without allocating a frame per predict. Three slots are enough for one
+        reader: the latest frame, the frame being detected and the frame being written.
+        :param slots: The number of frames preallocated on the first publish.
+        """
+        self.slots = slots
+
+        self.__slots = []
+        self.__latest = None
+        self.__lock = threading.Lock()
+
+    @property
+    def latest(self):
+        """
+        The last published FrameSlot, or None.
+        """
+        return self.__latest
+
+    def publish(self, frame, sequence=0):
+        """
+        Copy a frame into a free slot and make it the latest one.
+        :param frame: The input frame.
+        :param sequence: The sequence number of the frame.
+        :return: The FrameSlot holding the copy.
+        """
+        with self.__lock:
+            slot = self.__free_slot(frame)
+
+        np.copyto(slot.frame, frame)
+        slot.sequence = sequence
+
+        with self.__lock:
+            self.__latest = slot
+
+        return slot
+
+    def __free_slot(self, frame):
+        """
+        Find a slot that is neither referenced nor the latest one. The ring is (re)allocated when the frame format
+        changes, keeping the old slots only while they are referenced, and grows when every slot is in use.
+        :param frame: The input frame.
+        :return: The FrameSlot.
+        """
+        self.__slots = [slot for slot in self.__slots if slot.references or self.__same_format(slot, frame)]
+
+        if not any(self.__same_format(slot, frame) for slot in self.__slots):
+            self.__slots.extend(FrameSlot(frame.shape, frame.dtype) for _ in range(self.slots))
+
+        for slot in self.__slots:
+            if not slot.references and slot is not self.__latest and self.__same_format(slot, frame):
+                return slot
+
+        slot = FrameSlot(frame.shape, frame.dtype)
+        self.__slots.append(slot)
+
+        return slot
+
+    @staticmethod
+    def __same_format(slot, frame):
+        return slot.frame.shape == frame.shape and slot.frame.dtype == frame.dtype
+
+    def acquire_latest(self):
+        """
+        Reference the latest frame, so that it is not overwritten until it is released.
+        :return: The latest FrameSlot, or None when no frame was published.
+        """
+        with self.__lock:
+            slot = self.__latest
+
+            if slot is not None:
+                slot.references += 1
+
+        return slot
+
+    def release(self, slot):
+        """
+        Release a frame referenced by acquire_latest.
+        :param slot: The FrameSlot.
+        """
+        with self.__lock:
+            slot.references -= 1
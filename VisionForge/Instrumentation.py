@@ -0,0 +1,71 @@
+import threading
+from collections import defaultdict, deque
+import numpy as np
+
+
+class Instrumentation:
+    STAGES = ("predict", "preprocess", "match_template", "histogram", "detector_cycle", "staleness", "skipped")
+
+    def __init__(self, max_samples: int = 100000):
+        """
+        Initialize the Instrumentation object. Assign it to Tracking.instrumentation to record the per-stage timings:
+        'predict' (whole call), 'preprocess' (gray frame), 'match_template' and 'histogram' (per box),
+        'detector_cycle' (one YOLO cycle), 'staleness' (frames between the tracked frame and the frame of the boxes) and
+        'skipped' (boxes carried forward by change_gating, per frame). Timings are in seconds.
+        :param max_samples: The maximum number of samples kept per stage (the oldest are discarded).
+        """
+        self.max_samples = max_samples
+
+        self.__samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self.__lock = threading.Lock()
+
+    def record(self, stage, value):
+        """
+        Record one sample of a stage.
+        :param stage: The name of the stage.
+        :param value: The sample (seconds, frames for 'staleness' or boxes for 'skipped').
+        """
+        with self.__lock:
+            self.__samples[stage].append(value)
+
+    def samples(self, stage):
+        """
+        Get the samples of a stage.
+        :param stage: The name of the stage.
+        :return: Array with the samples.
+        """
+        with self.__lock:
+            return np.array(self.__samples.get(stage, ()), dtype=np.float64)
+
+    def reset(self):
+        """
+        Discard all the samples.
+        """
+        with self.__lock:
+            self.__samples.clear()
+
+    def summary(self):
+        """
+        Summarize the samples of every recorded stage.
+        :return: Dictionary {stage: {'count', 'mean', 'p50', 'p99', 'max'}}.
+        """
+        with self.__lock:
+            stages = list(self.__samples)
+
+        summary = {}
+
+        for stage in stages:
+            samples = self.samples(stage)
+
+            if not len(samples):
+                continue
+
+            summary[stage] = {
+                'count': len(samples),
+                'mean': float(samples.mean()),
+                'p50': float(np.percentile(samples, 50)),
+                'p99': float(np.percentile(samples, 99)),
+                'max': float(samples.max()),
+            }
+
+        return summary
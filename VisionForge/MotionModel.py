@@ -0,0 +1,65 @@
+import numpy as np
+
+
+class KalmanMotionModel:
+    __slots__ = ('state', 'covariance', '__transition', '__process_noise', '__measurement_noise')
+
+    def __init__(self, center, process_noise: float = 1.0, measurement_noise: float = 1.0,
+                 initial_velocity_std: float = 10.0):
+        """
+        Initialize the KalmanMotionModel object: a constant velocity Kalman filter on the center of a bounding box,
+        one step per frame.
+        :param center: The first measured center (x, y) of the bounding box.
+        :param process_noise: The standard deviation of the acceleration, in pixels per frame squared.
+        :param measurement_noise: The standard deviation of a measured center, in pixels.
+        :param initial_velocity_std: The standard deviation of the unknown initial velocity, in pixels per frame.
+        """
+        self.state = np.array([center[0], center[1], 0., 0.])
+        self.covariance = np.diag([measurement_noise ** 2, measurement_noise ** 2,
+                                   initial_velocity_std ** 2, initial_velocity_std ** 2])
+
+        self.__transition = np.array([[1., 0., 1., 0.],
+                                      [0., 1., 0., 1.],
+                                      [0., 0., 1., 0.],
+                                      [0., 0., 0., 1.]])
+
+        acceleration = np.array([[0.5, 0.], [0., 0.5], [1., 0.], [0., 1.]])
+        self.__process_noise = acceleration @ acceleration.T * process_noise ** 2
+        self.__measurement_noise = np.eye(2) * measurement_noise ** 2
+
+    @property
+    def center(self):
+        """
+        The estimated center (x, y) of the bounding box.
+        """
+        return self.state[0], self.state[1]
+
+    @property
+    def center_std(self):
+        """
+        The standard deviation (x, y) of the estimated center.
+        """
+        return np.sqrt(self.covariance[0, 0]), np.sqrt(self.covariance[1, 1])
+
+    def predict(self):
+        """
+        Advance the filter one frame.
+        :return: Tuple containing the predicted center (x, y) and its standard deviation (x, y).
+        """
+        self.state = self.__transition @ self.state
+        self.covariance = self.__transition @ self.covariance @ self.__transition.T + self.__process_noise
+
+        return self.center, self.center_std
+
+    def update(self, center):
+        """
+        Correct the filter with a measured center.
+        :param center: The measured center (x, y) of the bounding box.
+        """
+        innovation = np.asarray(center, dtype=float) - self.state[:2]
+        innovation_covariance = self.covariance[:2, :2] + self.__measurement_noise
+
+        gain = self.covariance[:, :2] @ np.linalg.inv(innovation_covariance)
+
+        self.state = self.state + gain @ innovation
+        self.covariance = self.covariance - gain @ self.covariance[:2, :]
@@ -0,0 +1,91 @@
+from pathlib import Path
+from typing import Union
+from .Tracking import Tracking
+from .Detectors import as_detector, load_detector
+from .BatchDetectionScheduler import BatchDetectionScheduler
+from .Exceptions import FrameNotFound
+
+
+class MultiStreamTracking:
+    def __init__(self, model_path: Union[str, Path] = "yolov8n.pt", model=None, max_batch_size: int = 8,
+                 max_wait_ms: float = 10):
+        """
+        Initialize the MultiStreamTracking object. Every stream has its own Tracking object (frame, boxes and
+        settings), while a single detector and a single detection thread are shared by all the streams.
+        :param model_path: The path to the model (see load_detector).
+        :type model_path: str or Path
+        :param model: An already loaded Detector (see Detectors) or YOLO model. When given, model_path is not loaded.
+        :param max_batch_size: The maximum number of stream frames in one YOLO predict.
+        :param max_wait_ms: The maximum time, in milliseconds, to wait for a batch to fill.
+        """
+        self.detector = as_detector(model) if model is not None else load_detector(model_path)
+        self.scheduler = BatchDetectionScheduler(self.detector, max_batch_size, max_wait_ms)
+
+        self.__streams = {}
+
+    def __getitem__(self, stream_id):
+        return self.__streams[stream_id]
+
+    def __contains__(self, stream_id):
+        return stream_id in self.__streams
+
+    def __len__(self):
+        return len(self.__streams)
+
+    @property
+    def model(self):
+        """
+        The ultralytics model of the shared detector, or None for the other detectors.
+        """
+        return getattr(self.detector, 'model', None)
+
+    @property
+    def stream_ids(self):
+        """
+        The ids of the registered streams.
+        """
+        return list(self.__streams)
+
+    def add_stream(self, stream_id=None):
+        """
+        Register a new stream.
+        :param stream_id: The id of the stream. When None, the next free integer is used.
+        :return: The Tracking object of the stream, which can be configured like a standalone Tracking.
+        """
+        if stream_id is None:
+            stream_id = len(self.__streams)
+            while stream_id in self.__streams:
+                stream_id += 1
+
+        if stream_id in self.__streams:
+            raise KeyError(f"Stream {stream_id!r} already exists")
+
+        tracking = Tracking(model=self.detector, scheduler=self.scheduler)
+        self.__streams[stream_id] = tracking
+
+        return tracking
+
+    def remove_stream(self, stream_id):
+        """
+        Unregister a stream. Pending detections of the stream are discarded.
+        :param stream_id: The id of the stream.
+        """
+        self.scheduler.discard(self.__streams.pop(stream_id))
+
+    def predict(self, stream_id, frame=None):
+        """
+        Predict the objects in the frame of a stream.
+        :param stream_id: The id of the stream.
+        :param frame: The input frame.
+        :return: List of dictionaries containing the results.
+        """
+        if frame is None:
+            raise FrameNotFound(f"Error: Frame Not Found (stream {stream_id!r})")
+
+        return self.__streams[stream_id].predict(frame)
+
+    def stop(self):
+        """
+        Stop the detection thread.
+        """
+        self.scheduler.stop()
@@ -1,64 +1,321 @@
+import threading
+import time
 import cv2
 import numpy as np
+from .MotionModel import KalmanMotionModel
+from .TrackLifecycle import TrackLifecycle
+
+# One record per tracked box, returned by Tracking.predict(frame, as_array=True). The label name of a record is
+# Tracking.names[label_id]; cords_subpixel equals cords unless subpixel_refinement is enabled and skipped is True when
+# change_gating carried the box forward without Template Matching.
+RESULT_DTYPE = np.dtype([
+    ('track_id', np.int64),
+    ('label_id', np.int32),
+    ('cords', np.int32, (4,)),
+    ('cords_yolo', np.int32, (4,)),
+    ('cords_larger', np.int32, (4,)),
+    ('cords_subpixel', np.float32, (4,)),
+    ('euclidean_intensity', np.float32),
+    ('template_matching_conf', np.float32),
+    ('yolo_conf', np.float32),
+    ('skipped', np.bool_),
+])
 
 
 class OpencvProcessing:
     def __init__(self, vf: 'Tracking'):
         self.__visionForge = vf
+        self.__lifecycle = TrackLifecycle(vf)
 
-    def __call__(self, frame, box):
+    def __call__(self, frame_data, box, as_array=False):
         """
         Perform Template Matching using OpenCV.
-        :param frame: The input image frame.
+        :param frame_data: The preprocessed input frame (see preprocess_frame).
         :param box: The dictionary containing the bounding box information.
-        :return: List of dictionaries containing the results.
+        :param as_array: Return the result as a tuple with the fields of RESULT_DTYPE instead of a dictionary.
+        :return: The dictionary (or tuple) containing the result, or an empty list when the box was not found.
         """
+        pending = box.pop('template_pending', None)
+
+        if pending is not None:
+            box['template_gray'], box['cords'], restart = pending
+            box['template_trim'] = (0, 0, 0, 0)
+            box.pop('template_hist', None)
+            box.pop('last_match', None)
+
+            if restart:
+                box.pop('motion', None)
+
         cords = box['cords'].copy()
-        template_image = box['template_image']
+        motion = self.__predict_motion(box, cords)
+
+        if self.__visionForge.change_gating and self.__unchanged(frame_data, box, cords):
+            if motion is not None:
+                motion.update(((cords[0] + cords[2]) / 2, (cords[1] + cords[3]) / 2))
+
+            larger_cords, subpixel, metrics = box['last_match']
+
+            if not self.__lifecycle.matched(box):
+                return []
+
+            return self.__result(box, cords, larger_cords, subpixel, metrics, True, as_array)
+
+        if self.__update_edge_trim(box, cords, frame_data.shape) or 'template_hist' not in box:
+            self.__prepare_template(box)
+
+        larger_cords = self.__preprocess_image(frame_data, cords, motion)
+        x_min_adjusted, y_min_adjusted = larger_cords[:2]
+
+        template_matching_result = self.detection(frame_data, larger_cords, box)
+
+        if template_matching_result is None:
+            box.pop('last_match', None)
+            self.__lifecycle.missed(box)
+
+            return []
+
+        (cv_x1, cv_y1, cv_x2, cv_y2), metrics, subpixel = template_matching_result
+        x1, y1, x2, y2 = ((x_min_adjusted + cv_x1),
+                          (y_min_adjusted + cv_y1),
+                          (x_min_adjusted + cv_x2),
+                          (y_min_adjusted + cv_y2))
+
+        box['cords'] = [x1, y1, x2, y2]
+
+        if motion is not None:
+            motion.update(((x1 + x2) / 2, (y1 + y2) / 2))
+
+        if self.__visionForge.template_update == "blend":
+            self.__blend_template(box, frame_data, metrics[1])
+
+        if self.__visionForge.change_gating:
+            # The box region of the matched frame is the reference of the change detector.
+            box['change_reference'] = frame_data.level(0)[y1: y2, x1: x2].copy()
+            box['last_match'] = (larger_cords, subpixel, metrics)
+
+        if not self.__lifecycle.matched(box):
+            return []
+
+        return self.__result(box, box['cords'], larger_cords, subpixel, metrics, False, as_array)
+
+    def __update_edge_trim(self, box, cords, shape):
+        """
+        Trim the template of a box pinned at a frame edge, which is leaving the frame: each frame it stays pinned, 2 more
+        pixels of that side are left out (while more than 10 remain). The trim is a view of the full template, given
+        back once the full template fits away from the edge again (the coordinates grow back by the restored pixels).
+        :param box: The dictionary containing the bounding box information.
+        :param cords: The coordinates of the bounding box, updated in place.
+        :param shape: The (height, width) of the frame.
+        :return: True when the trim changed and the template must be prepared again.
+        """
+        height, width = shape
+        template_height, template_width = box['template_gray'].shape
+        trim = box.get('template_trim', (0, 0, 0, 0))
+        left, top, right, bottom = trim
+
+        if self.__visionForge.horizontal_tracking:
+            if cords[0] == 0 and template_width - left - right - 2 > 10:
+                left += 2
+            elif left and cords[0] > left:
+                cords[0] -= left
+                left = 0
+
+            if cords[2] == width and template_width - left - right - 2 > 10:
+                right += 2
+            elif right and width - cords[2] > right:
+                cords[2] += right
+                right = 0
+
+        if self.__visionForge.vertical_tracking:
+            if cords[1] == 0 and template_height - top - bottom - 2 > 10:
+                top += 2
+            elif top and cords[1] > top:
+                cords[1] -= top
+                top = 0
+
+            if cords[3] == height and template_height - top - bottom - 2 > 10:
+                bottom += 2
+            elif bottom and height - cords[3] > bottom:
+                cords[3] += bottom
+                bottom = 0
+
+        box['template_trim'] = (left, top, right, bottom)
+
+        return (left, top, right, bottom) != trim
+
+    def __blend_template(self, box, frame_data, template_matching_conf):
+        """
+        Blend the matched region into the full template (exponential moving average with template_update_rate), for
+        matches of template_blend_confidence or more of a box that is not trimmed at a frame edge.
+        :param box: The dictionary containing the bounding box information.
+        :param frame_data: The preprocessed input frame.
+        :param template_matching_conf: The confidence of the match.
+        """
+        if template_matching_conf < self.__visionForge.template_blend_confidence or any(box['template_trim']):
+            return
+
+        x1, y1, x2, y2 = box['cords']
+        region = frame_data.level(0)[y1: y2, x1: x2]
+        template_gray = box['template_gray']
+
+        if region.shape != template_gray.shape:
+            return
+
+        rate = self.__visionForge.template_update_rate
+        box['template_gray'] = cv2.addWeighted(template_gray, 1 - rate, region, rate, 0)
+        self.__prepare_template(box)
+
+    def __result(self, box, cords, larger_cords, subpixel, metrics, skipped, as_array):
+        """
+        Build the result of a tracked box.
+        :param box: The dictionary containing the bounding box information.
+        :param cords: The tracked coordinates (x_min, y_min, x_max, y_max).
+        :param larger_cords: The coordinates of the larger image searched.
+        :param subpixel: The subpixel offset (dx, dy) of the match.
+        :param metrics: Tuple containing the euclidean intensity and the template matching confidence.
+        :param skipped: Whether change_gating carried the box forward without Template Matching.
+        :param as_array: Return a tuple with the fields of RESULT_DTYPE instead of a dictionary.
+        :return: The dictionary (or tuple) containing the result.
+        """
+        x1, y1, x2, y2 = cords
+        subpixel_x, subpixel_y = subpixel
+        euclidean_intensity, template_matching_conf = metrics
+
+        if as_array:
+            return (box['key'], box['label_id'], (x1, y1, x2, y2), box['original_cords_yolo'], larger_cords,
+                    (x1 + subpixel_x, y1 + subpixel_y, x2 + subpixel_x, y2 + subpixel_y),
+                    euclidean_intensity, template_matching_conf, box['confidence'], skipped)
+
+        result = {
+            'track_id': box['key'],
+            'label': box['label'],
+            'label_id': box['label_id'],
+            'cords': [x1, y1, x2, y2],
+            'cords_yolo': box['original_cords_yolo'],
+            'cords_larger': list(larger_cords),
+            'euclidean_intensity': euclidean_intensity,
+            'template_matching_conf': template_matching_conf,
+            'yolo_conf': box['confidence']
+        }
+
+        if self.__visionForge.subpixel_refinement:
+            result['cords_subpixel'] = [x1 + subpixel_x, y1 + subpixel_y, x2 + subpixel_x, y2 + subpixel_y]
+
+        if self.__visionForge.change_gating:
+            result['skipped'] = skipped
+
+        return result
+
+    def __unchanged(self, frame_data, box, cords):
+        """
+        Check whether the region of the box is unchanged since its last match: the mean absolute gray difference
+        against the region stored at that match is at most change_threshold. The reference is the matched frame, not
+        the previous one, so slow motion accumulates until it is detected.
+        :param frame_data: The preprocessed input frame.
+        :param box: The dictionary containing the bounding box information.
+        :param cords: The coordinates of the bounding box.
+        :return: True when the box can be carried forward without Template Matching.
+        """
+        reference = box.get('change_reference')
+
+        if reference is None or 'last_match' not in box:
+            return False
+
+        region = frame_data.level(0)[cords[1]: cords[3], cords[0]: cords[2]]
+
+        if region.shape != reference.shape or not region.size:
+            return False
+
+        return cv2.norm(region, reference, cv2.NORM_L1) <= self.__visionForge.change_threshold * region.size
+
+    def preprocess_frame(self, frame):
+        """
+        Convert the frame once for all the boxes: the gray frame and its pyramid levels, which the boxes slice instead
+        of converting and resizing their own crops.
+        :param frame: The input image frame (BGR).
+        :return: The FramePyramid of the frame.
+        """
+        return FramePyramid(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+    def __pyramid_level(self, template_gray):
+        """
+        Choose the coarsest pyramid level used to search the template.
+        :param template_gray: The gray template image.
+        :return: The pyramid level (0 is the full resolution).
+        """
+        pyramid_levels = self.__visionForge.pyramid_levels
+        min_side = min(template_gray.shape)
+
+        if pyramid_levels == "auto":
+            max_level = self.__visionForge.max_pyramid_level
+            min_size = self.__visionForge.min_pyramid_template_size
+            # The coarse search is never finer than half resolution, which a full resolution refine only sharpens.
+            level = 1 if max_level >= 1 and min_side >= 4 else 0
+        else:
+            max_level = pyramid_levels
+            min_size = 4
+            level = 0
+
+        while level < max_level and (min_side >> (level + 1)) >= min_size:
+            level += 1
 
-        ((larger_image, template),
-         (x_min_adjusted, y_min_adjusted, x_max_adjusted, y_max_adjusted)) = self.__preprocess_image(frame, cords,
-                                                                                                     template_image)
-        box['template_image'] = template
+        return level
 
-        template_matching_result = self.detection(larger_image, template)
+    def __prepare_template(self, box):
+        """
+        Store the template already converted: pyramid levels and normalized histogram of the full template
+        (template_gray) minus its edge trim.
+        :param box: The dictionary containing the bounding box information.
+        """
+        left, top, right, bottom = box.get('template_trim', (0, 0, 0, 0))
+        full_height, full_width = box['template_gray'].shape
+        template_gray = box['template_gray'][top: full_height - bottom, left: full_width - right]
+        template_pyramid = [template_gray]
+
+        for _ in range(self.__pyramid_level(template_gray)):
+            template_pyramid.append(cv2.pyrDown(template_pyramid[-1]))
+
+        box['template_pyramid'] = template_pyramid
+        box['template_hist'] = self.__calc_gray_histogram(template_gray)
+
+    def __predict_motion(self, box, cords):
+        """
+        Advance the motion model of the box to the current frame, creating it on first use.
+        :param box: The dictionary containing the bounding box information.
+        :param cords: The coordinates of the bounding box.
+        :return: The KalmanMotionModel of the box, or None when adaptive_search is disabled.
+        """
+        if not self.__visionForge.adaptive_search:
+            return None
 
-        if template_matching_result is not None:
-            (cv_x1, cv_y1, cv_x2, cv_y2), (euclidean_intensity, template_matching_conf) = template_matching_result
-            x1, y1, x2, y2 = ((x_min_adjusted + cv_x1),
-                              (y_min_adjusted + cv_y1),
-                              (x_min_adjusted + cv_x2),
-                              (y_min_adjusted + cv_y2))
+        motion = box.get('motion')
 
-            box['cords'] = [x1, y1, x2, y2]
+        if motion is None:
+            motion = KalmanMotionModel(((cords[0] + cords[2]) / 2, (cords[1] + cords[3]) / 2),
+                                       self.__visionForge.motion_process_noise,
+                                       self.__visionForge.motion_measurement_noise)
+            box['motion'] = motion
 
-            return {
-                'label': box['label'],
-                'cords': [x1, y1, x2, y2],
-                'cords_yolo': box['original_cords_yolo'],
-                'cords_larger': [x_min_adjusted, y_min_adjusted, x_max_adjusted, y_max_adjusted],
-                'euclidean_intensity': euclidean_intensity,
-                'template_matching_conf': template_matching_conf,
-                'yolo_conf': box['confidence']
-            }
+        motion.predict()
 
-        return []
+        return motion
 
-    def __preprocess_image(self, frame, cords, template):
+    def __preprocess_image(self, frame_data, cords, motion=None):
         """
-        Create a larger image and adjust a Template (Template Matching in OpenCV) by adjusting the coordinates of the bounding box.
+        Create a larger image (Template Matching in OpenCV) by adjusting the coordinates of the bounding box. The edge
+        trim of the template is handled by __update_edge_trim.
 
-        :param frame: The input image frame.
-        :param template: The image used in the match template.
+        :param frame_data: The preprocessed input frame.
         :param cords: The coordinates (x_min, y_min, x_max, y_max) of the bounding box.
-        :return: Tuple containing larger_image, adjusted coordinates (x_min_adjusted, y_min_adjusted, x_max_adjusted,
-                    y_max_adjusted).
+        :param motion: The KalmanMotionModel of the box, when adaptive_search is enabled.
+        :return: The adjusted coordinates of the larger image (x_min_adjusted, y_min_adjusted, x_max_adjusted,
+                 y_max_adjusted).
         """
 
-        height, width, _ = frame.shape
+        height, width = frame_data.shape
 
         (x_min_adjusted, y_min_adjusted,
-         x_max_adjusted, y_max_adjusted) = self.__visionForge.generate_cords_large_template(cords)
+         x_max_adjusted, y_max_adjusted) = self.__visionForge.generate_cords_large_template(cords, motion)
 
         if x_min_adjusted < 0:
             x_max_adjusted += x_min_adjusted
@@ -76,63 +333,156 @@ class OpencvProcessing:
             y_min_adjusted += diff
             y_max_adjusted = height
 
-        if cords[0] == 0 and (template.shape[1] - 2) > 10 and self.__visionForge.horizontal_tracking:
-            template = template[:, 2:]
+        larger_cords = (x_min_adjusted, y_min_adjusted, x_max_adjusted, y_max_adjusted)
 
-        if cords[1] == 0 and (template.shape[0] - 2) > 10 and self.__visionForge.vertical_tracking:
-            template = template[2:, :]
+        return larger_cords
 
-        if cords[2] == width and (template.shape[1] - 2) > 10 and self.__visionForge.horizontal_tracking:
-            template = template[:, :-2]
+    def detection(self, frame_data, larger_cords, box):
+        """
+        Perform Template Matching using OpenCV. The template is searched coarse-to-fine: over the whole larger image at
+        the coarsest pyramid level of the template, then in a small neighbourhood of that match at each finer level.
+        :param frame_data: The preprocessed input frame (FramePyramid).
+        :param larger_cords: The coordinates of the larger image (x_min, y_min, x_max, y_max) used in the match template.
+        :param box: The dictionary containing the prepared template images.
+        :return: Tuple containing the coordinates of the bounding box, the similarity metrics and the subpixel offset
+                 (dx, dy) of the match.
+        """
+        x_min, y_min, x_max, y_max = larger_cords
+        template_pyramid = box['template_pyramid']
+        h_template, w_template = template_pyramid[0].shape
 
-        if cords[3] == height and (template.shape[0] - 2) > 10 and self.__visionForge.vertical_tracking:
-            template = template[:-2, :]
+        if x_max - x_min < w_template or y_max - y_min < h_template:
+            return None
 
-        larger_image = frame[
-                       y_min_adjusted: y_max_adjusted,
-                       x_min_adjusted: x_max_adjusted
-                       ]
+        instrumentation = self.__visionForge.instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
 
-        return (larger_image, template), (x_min_adjusted, y_min_adjusted, x_max_adjusted, y_max_adjusted)
+        coarse_method = self.__visionForge.pyramid_coarse_method
+        margin = self.__visionForge.pyramid_refine_margin
+        coarse_x, coarse_y = x_min, y_min
+        radius = max(x_max - x_min, y_max - y_min)
 
-    def detection(self, larger_image, template_image):
-        """
-        Perform Template Matching using OpenCV.
-        :param larger_image: Template image large scale used in the match template.
-        :param template_image: Template image used in the match template.
-        :return: Tuple containing the coordinates of the bounding box and the similarity metrics.
-        """
-        larger_image_gray = cv2.cvtColor(larger_image, cv2.COLOR_BGR2GRAY)
-        template_image_gray = cv2.cvtColor(template_image, cv2.COLOR_BGR2GRAY)
+        for level in range(len(template_pyramid) - 1, 0, -1):
+            larger_image_level = frame_data.level(level)[y_min >> level: y_max >> level, x_min >> level: x_max >> level]
+            template_level = template_pyramid[level]
+
+            if larger_image_level.shape[0] < template_level.shape[0] or \
+                    larger_image_level.shape[1] < template_level.shape[1]:
+                continue
 
-        w_larger, h_larger = larger_image_gray.shape[::-1]
-        w_template, h_template = template_image_gray.shape[::-1]
+            res = cv2.matchTemplate(larger_image_level, template_level, coarse_method)
+            coarse_x, coarse_y = self.__best_location(res, coarse_method)
+            coarse_x, coarse_y = (x_min >> level) + coarse_x, (y_min >> level) + coarse_y
 
-        resized_larger_image_gray = cv2.resize(larger_image_gray, (w_larger // 2, h_larger // 2))
-        resized_template_image_gray = cv2.resize(template_image_gray, (w_template // 2, h_template // 2))
+            # Each finer level only searches the neighbourhood of the match of the level above.
+            for finer in range(level - 1, 0, -1):
+                coarse_x, coarse_y, _ = self.__refine(frame_data.level(finer), template_pyramid[finer],
+                                                      coarse_x << 1, coarse_y << 1, 1 + margin,
+                                                      [value >> finer for value in larger_cords], coarse_method)
 
-        res = cv2.matchTemplate(resized_larger_image_gray, resized_template_image_gray,
-                                self.__visionForge.template_matching_method)
+            coarse_x, coarse_y, radius = coarse_x << 1, coarse_y << 1, 1 + margin
+            break
+
+        gray = frame_data.level(0)
+
+        refine_x1, refine_y1, res = self.__refine(gray, template_pyramid[0], coarse_x, coarse_y, radius, larger_cords,
+                                                  self.__visionForge.template_matching_method, origin=True)
 
         min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
 
-        cv_x1, cv_y1 = max_loc
-        cv_x1 *= 2
-        cv_y1 *= 2
+        if instrumentation is not None:
+            instrumentation.record('match_template', time.perf_counter() - start)
+
+        cv_x1 = refine_x1 + max_loc[0] - x_min
+        cv_y1 = refine_y1 + max_loc[1] - y_min
 
         cv_x2, cv_y2 = cv_x1 + w_template, cv_y1 + h_template
 
         if max_val >= self.__visionForge.match_template_confidence:
-            hist_intensity1 = self.__calc_gray_histogram(template_image_gray)
-            hist_intensity2 = self.__calc_gray_histogram(larger_image_gray[cv_y1:cv_y2, cv_x1:cv_x2])
+            if instrumentation is not None:
+                start = time.perf_counter()
+
+            hist_intensity1 = box['template_hist']
+            hist_intensity2 = self.__calc_gray_histogram(gray[y_min + cv_y1: y_min + cv_y2,
+                                                              x_min + cv_x1: x_min + cv_x2])
 
             euclidean_intensity = self.__calculate_similarity(hist_intensity1, hist_intensity2)
 
+            if instrumentation is not None:
+                instrumentation.record('histogram', time.perf_counter() - start)
+
             if euclidean_intensity <= self.__visionForge.euclidean_distance:
-                return (cv_x1, cv_y1, cv_x2, cv_y2), (euclidean_intensity, max_val)
+                subpixel = self.__subpixel_offset(res, max_loc) if self.__visionForge.subpixel_refinement else (0., 0.)
+
+                return (cv_x1, cv_y1, cv_x2, cv_y2), (euclidean_intensity, max_val), subpixel
 
         return None
 
+    @staticmethod
+    def __best_location(res, method):
+        """
+        :return: The location (x, y) of the best score of a match template result.
+        """
+        _, _, min_loc, max_loc = cv2.minMaxLoc(res)
+
+        return min_loc if method in (cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED) else max_loc
+
+    def __refine(self, image, template, x, y, radius, bounds, method, origin=False):
+        """
+        Match the template within radius pixels of a location, inside the bounds of the larger image.
+        :param image: The gray frame at the level of the template.
+        :param template: The template at that level.
+        :param x: The expected x_min of the template.
+        :param y: The expected y_min of the template.
+        :param radius: The search radius.
+        :param bounds: The larger image (x_min, y_min, x_max, y_max) at that level.
+        :param method: The template matching method.
+        :param origin: Return the origin of the searched window and the match result instead of the best location.
+        :return: Tuple containing the best location (x, y) and the match result, or the origin (x, y) of the window and
+                 the match result.
+        """
+        x_min, y_min, x_max, y_max = bounds
+        h_template, w_template = template.shape
+
+        x1 = max(min(max(x - radius, x_min), x_max - w_template), 0)
+        y1 = max(min(max(y - radius, y_min), y_max - h_template), 0)
+        x2 = min(max(min(x + w_template + radius, x_max), x1 + w_template), image.shape[1])
+        y2 = min(max(min(y + h_template + radius, y_max), y1 + h_template), image.shape[0])
+
+        res = cv2.matchTemplate(image[y1: y2, x1: x2], template, method)
+
+        if origin:
+            return x1, y1, res
+
+        best_x, best_y = self.__best_location(res, method)
+
+        return x1 + best_x, y1 + best_y, res
+
+    @staticmethod
+    def __subpixel_offset(res, loc):
+        """
+        Interpolate the peak of the match result with a parabola on each axis.
+        :param res: The match template result.
+        :param loc: The integer location (x, y) of the peak.
+        :return: Tuple containing the offset (dx, dy) of the peak, each in [-0.5, 0.5].
+        """
+        x, y = loc
+        offset = []
+
+        for previous, peak, following in ((res[y, x - 1] if x > 0 else None, res[y, x],
+                                           res[y, x + 1] if x + 1 < res.shape[1] else None),
+                                          (res[y - 1, x] if y > 0 else None, res[y, x],
+                                           res[y + 1, x] if y + 1 < res.shape[0] else None)):
+            denominator = 0. if previous is None or following is None else previous - 2 * peak + following
+
+            if denominator >= 0:
+                offset.append(0.)
+            else:
+                offset.append(float(np.clip(0.5 * (previous - following) / denominator, -0.5, 0.5)))
+
+        return tuple(offset)
+
     def __calc_gray_histogram(self, img):
         """
         Calculate the histogram of the image.
@@ -146,3 +496,30 @@ class OpencvProcessing:
 
     def __calculate_similarity(self, hist1, hist2):
         return np.linalg.norm(hist1 - hist2)
+
+
+class FramePyramid:
+    __slots__ = ('shape', '__levels', '__lock')
+
+    def __init__(self, gray):
+        """
+        Initialize the FramePyramid object. The pyramid levels (each one half the size of the previous one) are built
+        on first use and shared by all the boxes of the frame.
+        :param gray: The gray frame (level 0).
+        """
+        self.shape = gray.shape
+        self.__levels = [gray]
+        self.__lock = threading.Lock()
+
+    def level(self, level):
+        """
+        Get a pyramid level of the frame.
+        :param level: The pyramid level (0 is the full resolution).
+        :return: The gray image of the level.
+        """
+        if level >= len(self.__levels):
+            with self.__lock:
+                while level >= len(self.__levels):
+                    self.__levels.append(cv2.pyrDown(self.__levels[-1]))
+
+        return self.__levels[level]
@@ -0,0 +1,163 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Union
+import numpy as np
+from .Detectors import Detector, load_detector
+
+
+def _detection_worker(model_path, backend, connection):
+    """
+    Entry point of the detector process. Loads the detector and answers the detection requests of the parent process,
+    reading the frames from the shared memory buffer.
+    :param model_path: The path to the model.
+    :param backend: The detector backend (see load_detector).
+    :param connection: The process end of the Pipe used to exchange the requests and the results.
+    """
+    buffer = None
+    frames = None
+
+    try:
+        detector = load_detector(model_path, backend)
+        connection.send(('ready', dict(detector.names)))
+    except Exception as e:
+        connection.send(('error', repr(e)))
+        return
+
+    while True:
+        message = connection.recv()
+
+        if message is None:
+            break
+
+        try:
+            if message[0] == 'buffer':
+                _, name, shape, dtype = message
+
+                if buffer is not None:
+                    buffer.close()
+
+                buffer = shared_memory.SharedMemory(name=name)
+                frames = np.ndarray(shape, dtype=dtype, buffer=buffer.buf)
+
+            elif message[0] == 'detect':
+                _, count, confidence = message
+
+                detections = detector.detect([frames[slot] for slot in range(count)], confidence)
+                connection.send(('result', (detections, dict(detector.names))))
+        except Exception as e:
+            connection.send(('error', repr(e)))
+
+    detector.close()
+    frames = None
+    if buffer is not None:
+        buffer.close()
+
+
+class ProcessDetector(Detector):
+    def __init__(self, model_path: Union[str, Path] = "yolov8n.pt", slots: int = 2, backend: str = "auto"):
+        """
+        Initialize the ProcessDetector object. The detector runs in a separate process, so its Python
+        pre/post-processing does not compete for the GIL with the Template Matching. The frames are written to a
+        shared memory buffer (no pickling) and only the compact box arrays come back.
+        :param model_path: The path to the model.
+        :type model_path: str or Path
+        :param slots: The number of frames in the shared memory buffer. It grows to the largest batch.
+        :param backend: The detector backend used by the process (see load_detector).
+        """
+        self.slots = slots
+        self.names = {}
+
+        self.__buffer = None
+        self.__frames = None
+
+        context = mp.get_context('spawn')
+        self.__connection, child_connection = context.Pipe()
+        self.__process = context.Process(target=_detection_worker, args=(str(model_path).strip(), backend,
+                                                                                 child_connection),
+                                         daemon=True)
+        self.__process.start()
+
+        status, payload = self.__connection.recv()
+        if status == 'error':
+            self.close()
+            raise RuntimeError(f"Detector process failed to load the model: {payload}")
+
+        self.names = payload
+
+    def __ensure_buffer(self, frame, count):
+        """
+        Create (or recreate, when the frame format changes or the batch does not fit) the shared memory buffer.
+        :param frame: The first frame of the batch.
+        :param count: The number of frames in the batch.
+        """
+        if self.__frames is not None and self.__frames.shape[1:] == frame.shape and \
+                self.__frames.dtype == frame.dtype and len(self.__frames) >= count:
+            return
+
+        self.__release_buffer()
+
+        self.slots = max(self.slots, count)
+        shape = (self.slots,) + frame.shape
+        self.__buffer = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * frame.dtype.itemsize)
+        self.__frames = np.ndarray(shape, dtype=frame.dtype, buffer=self.__buffer.buf)
+
+        self.__connection.send(('buffer', self.__buffer.name, shape, frame.dtype.str))
+
+    def __release_buffer(self):
+        """
+        Release the shared memory buffer.
+        """
+        if self.__buffer is not None:
+            self.__frames = None
+            self.__buffer.close()
+            self.__buffer.unlink()
+            self.__buffer = None
+
+    def detect(self, frames, confidence):
+        """
+        Perform object detection on the detector process.
+        :param frames: List of frames.
+        :param confidence: The minimum confidence of the detections.
+        :return: List with one (xyxy, confidences, class_ids) tuple per frame.
+        """
+        frames = list(frames)
+
+        if not frames:
+            return []
+
+        # The shared buffer holds frames of one format; a mixed batch is sent one frame at a time.
+        if any(frame.shape != frames[0].shape or frame.dtype != frames[0].dtype for frame in frames[1:]):
+            return [self.detect([frame], confidence)[0] for frame in frames]
+
+        self.__ensure_buffer(frames[0], len(frames))
+
+        for slot, frame in enumerate(frames):
+            np.copyto(self.__frames[slot], frame)
+
+        self.__connection.send(('detect', len(frames), confidence))
+
+        status, payload = self.__connection.recv()
+        if status == 'error':
+            raise RuntimeError(f"Detector process failed: {payload}")
+
+        detections, self.names = payload
+
+        return detections
+
+    def close(self):
+        """
+        Stop the detector process and release the shared memory.
+        """
+        if self.__process.is_alive():
+            try:
+                self.__connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.__process.join(timeout=5)
+
+            if self.__process.is_alive():
+                self.__process.terminate()
+
+        self.__release_buffer()
+        self.__connection.close()
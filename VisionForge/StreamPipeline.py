@@ -0,0 +1,212 @@
+import queue
+import threading
+import time
+import cv2
+
+_END = object()
+
+
+class _StageError:
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+class StreamPipeline:
+    DROP_POLICIES = ("block", "drop_oldest", "latest")
+
+    def __init__(self, vf: 'Tracking', source, annotate=None, queue_size: int = 4, drop_policy: str = "block"):
+        """
+        Initialize the StreamPipeline object. Capture/decode, tracking and the optional annotate/encode stage run on
+        their own threads, connected by bounded queues, so decoding the next frame and writing the previous one
+        overlap with the tracking.
+        :param vf: The Tracking object.
+        :param source: A video path, URL or camera index (opened with cv2.VideoCapture), an opened cv2.VideoCapture or
+                       any iterable of frames.
+        :param annotate: Optional callable (frame, results) -> output, run on its own stage (e.g. drawing the boxes and
+                         writing or encoding the frame). Its return value is yielded as 'output'.
+        :param queue_size: The maximum number of frames waiting between two stages.
+        :param drop_policy: What the capture stage does when the tracking stage is behind: "block" waits (every
+                            frame is tracked, back-pressure up to the source), "drop_oldest" discards the oldest
+                            waiting frame and "latest" keeps only the newest frame (for live cameras).
+        """
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop_policy!r}")
+
+        self.__visionForge = vf
+        self.__source = source
+        self.__annotate = annotate
+        self.drop_policy = drop_policy
+        self.dropped_frames = 0
+
+        self.__capture_queue = queue.Queue(maxsize=1 if drop_policy == "latest" else queue_size)
+        self.__tracking_queue = queue.Queue(maxsize=queue_size)
+        self.__output_queue = queue.Queue(maxsize=queue_size) if annotate is not None else self.__tracking_queue
+
+        self.__stop_event = threading.Event()
+        self.__threads = [threading.Thread(target=self.__capture_stage, daemon=True),
+                          threading.Thread(target=self.__tracking_stage, daemon=True)]
+
+        if annotate is not None:
+            self.__threads.append(threading.Thread(target=self.__annotate_stage, daemon=True))
+
+    def __iter__(self):
+        """
+        Start the stages and yield the result of each frame, in order: a dictionary with the frame 'index', its
+        capture 'timestamp' (time.time()), the 'frame', the tracking 'results' and the annotate 'output' (or None).
+        """
+        for thread in self.__threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self.__get(self.__output_queue)
+
+                if item is _END:
+                    break
+                if isinstance(item, _StageError):
+                    raise item.error
+
+                yield item
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop the stages and wait for their threads.
+        """
+        self.__stop_event.set()
+
+        for thread in self.__threads:
+            if thread.is_alive() and thread is not threading.current_thread():
+                thread.join()
+
+    def __frames(self):
+        """
+        Iterate over the frames of the source.
+        """
+        source = self.__source
+
+        if isinstance(source, (str, int)):
+            source = cv2.VideoCapture(source)
+            owns_capture = True
+        else:
+            owns_capture = False
+
+        if not hasattr(source, 'read'):
+            yield from source
+            return
+
+        try:
+            while True:
+                ret, frame = source.read()
+
+                if not ret:
+                    break
+
+                yield frame
+        finally:
+            if owns_capture:
+                source.release()
+
+    def __put(self, stage_queue, item):
+        """
+        Put an item on a queue, waiting while it is full (back-pressure) unless the pipeline is stopped.
+        :return: False when the pipeline was stopped.
+        """
+        while not self.__stop_event.is_set():
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def __get(self, stage_queue):
+        """
+        Get an item from a queue, waiting while it is empty unless the pipeline is stopped.
+        :return: The item, or _END when the pipeline was stopped.
+        """
+        while not self.__stop_event.is_set():
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return _END
+
+    def __put_frame(self, item):
+        """
+        Put a captured frame on the capture queue, applying the drop policy.
+        :return: False when the pipeline was stopped.
+        """
+        if self.drop_policy == "block":
+            return self.__put(self.__capture_queue, item)
+
+        while not self.__stop_event.is_set():
+            try:
+                self.__capture_queue.put_nowait(item)
+                return True
+            except queue.Full:
+                try:
+                    self.__capture_queue.get_nowait()
+                    self.dropped_frames += 1
+                except queue.Empty:
+                    pass
+
+        return False
+
+    def __capture_stage(self):
+        """
+        Read the frames of the source.
+        """
+        try:
+            for index, frame in enumerate(self.__frames()):
+                if not self.__put_frame({'index': index, 'timestamp': time.time(), 'frame': frame}):
+                    return
+            self.__put(self.__capture_queue, _END)
+        except Exception as e:
+            self.__put(self.__capture_queue, _StageError(e))
+
+    def __tracking_stage(self):
+        """
+        Track the captured frames.
+        """
+        self.__run_stage(self.__capture_queue, self.__tracking_queue, self.__track)
+
+    def __annotate_stage(self):
+        """
+        Annotate/encode the tracked frames.
+        """
+        self.__run_stage(self.__tracking_queue, self.__output_queue, self.__annotate_item)
+
+    def __run_stage(self, input_queue, output_queue, process):
+        """
+        Process the items of a stage until the end of the stream, forwarding the end marker and the errors.
+        """
+        while True:
+            item = self.__get(input_queue)
+
+            if item is _END or isinstance(item, _StageError):
+                self.__put(output_queue, item)
+                return
+
+            try:
+                item = process(item)
+            except Exception as e:
+                self.__put(output_queue, _StageError(e))
+                return
+
+            if not self.__put(output_queue, item):
+                return
+
+    def __track(self, item):
+        item['results'] = self.__visionForge.predict(item['frame'])
+        item['output'] = None
+        return item
+
+    def __annotate_item(self, item):
+        item['output'] = self.__annotate(item['frame'], item['results'])
+        return item
@@ -0,0 +1,131 @@
+TENTATIVE = "tentative"
+CONFIRMED = "confirmed"
+LOST = "lost"
+DELETED = "deleted"
+
+# Eviction order when the templates exceed template_memory_limit: lost tracks first, then tentative, then confirmed.
+_EVICTION_RANK = {DELETED: 0, LOST: 1, TENTATIVE: 2, CONFIRMED: 3}
+
+
+class TrackLifecycle:
+    def __init__(self, vf: 'Tracking'):
+        """
+        Initialize the TrackLifecycle object, which moves the tracks (box dictionaries) through the states tentative,
+        confirmed, lost and deleted, following the settings of the Tracking.
+        :param vf: The Tracking object.
+        """
+        self.__visionForge = vf
+
+    def created(self, box):
+        """
+        Initialize the state of a track created from a detection.
+        :param box: The dictionary containing the bounding box information.
+        """
+        box['hits'] = 1
+        box['misses'] = 0
+        box['detection_misses'] = 0
+        box['last_seen'] = self.__visionForge.frame_sequence
+        box['state'] = CONFIRMED if self.__visionForge.track_min_hits <= 1 else TENTATIVE
+
+    def detected(self, box):
+        """
+        Update a track associated with a new detection.
+        :param box: The dictionary containing the bounding box information.
+        """
+        box['hits'] += 1
+        box['misses'] = 0
+        box['detection_misses'] = 0
+        box['last_seen'] = self.__visionForge.frame_sequence
+        box['state'] = self.__active_state(box)
+
+    def missed_by_detector(self, box):
+        """
+        Update a track that no detection was associated with.
+        :param box: The dictionary containing the bounding box information.
+        :return: True when the track survives the detection cycle.
+        """
+        box['detection_misses'] += 1
+
+        if box['state'] != CONFIRMED or box['detection_misses'] > self.__visionForge.track_max_detection_misses:
+            box['state'] = DELETED
+            return False
+
+        return True
+
+    def matched(self, box):
+        """
+        Update a track found by the Template Matching.
+        :param box: The dictionary containing the bounding box information.
+        :return: True when the track is reported (confirmed).
+        """
+        box['misses'] = 0
+        box['last_seen'] = self.__visionForge.frame_sequence
+
+        if box['state'] != DELETED:
+            box['state'] = self.__active_state(box)
+
+        return box['state'] == CONFIRMED
+
+    def missed(self, box):
+        """
+        Update a track not found by the Template Matching. It is deleted after track_max_age frames lost.
+        :param box: The dictionary containing the bounding box information.
+        """
+        box['misses'] += 1
+
+        if box['state'] != DELETED:
+            box['state'] = DELETED if box['misses'] > self.__visionForge.track_max_age else LOST
+
+    def prune(self, boxes_dict):
+        """
+        Remove the deleted tracks and, when the templates exceed template_memory_limit, evict the least valuable tracks
+        (lost, then tentative, then confirmed, the longest unseen first).
+        :param boxes_dict: The dictionary of tracks {track id: box}.
+        :return: The number of tracks removed.
+        """
+        removed = [key for key, box in list(boxes_dict.items()) if box.get('state') == DELETED]
+
+        for key in removed:
+            boxes_dict.pop(key, None)
+
+        memory_limit = self.__visionForge.template_memory_limit
+
+        if memory_limit is None:
+            return len(removed)
+
+        boxes = list(boxes_dict.values())
+        total = sum(self.template_bytes(box) for box in boxes)
+
+        if total <= memory_limit:
+            return len(removed)
+
+        for box in sorted(boxes, key=lambda box: (_EVICTION_RANK.get(box.get('state'), 3), box.get('last_seen', 0))):
+            if total <= memory_limit:
+                break
+
+            total -= self.template_bytes(box)
+            box['state'] = DELETED
+            boxes_dict.pop(box['key'], None)
+            removed.append(box['key'])
+
+        return len(removed)
+
+    @staticmethod
+    def template_bytes(box):
+        """
+        Calculate the memory held by the template images of a track.
+        :param box: The dictionary containing the bounding box information.
+        :return: The number of bytes.
+        """
+        total = box['template_gray'].nbytes
+
+        for image in box.get('template_pyramid', ())[1:]:
+            total += image.nbytes
+
+        if box.get('change_reference') is not None:
+            total += box['change_reference'].nbytes
+
+        return total
+
+    def __active_state(self, box):
+        return CONFIRMED if box['hits'] >= self.__visionForge.track_min_hits else TENTATIVE
@@ -0,0 +1,348 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Union
+import numpy as np
+
+# Kinds of record: the result of one tracked box, or one detection of a YOLO cycle.
+TRACK = 0
+DETECTION = 1
+
+# Association of a DETECTION record: the detection created the track, was associated with it (restarting its template
+# when it was lost) or was filtered (below yolo_confidence, or without area once clipped to the frame).
+NEW = 0
+MATCHED = 1
+RESTARTED = 2
+FILTERED = 3
+
+# One fixed-size, packed, little-endian record. 'frame' is the 0-based index of the tracked frame (Tracking.frame_sequence
+# - 1). For a TRACK record, 'detection_frame' is the frame the boxes were detected on; for a DETECTION record, 'frame'
+# is the first frame tracked with the detection, 'detection_frame' the frame the detector ran on and 'track_id' the
+# track the detection was assigned to ('association'). A YOLO cycle without detections is logged as one DETECTION
+# record with label_id -1.
+TRACK_LOG_DTYPE = np.dtype([
+    ('frame', '<i8'),
+    ('detection_frame', '<i8'),
+    ('timestamp', '<f8'),
+    ('kind', 'u1'),
+    ('track_id', '<i8'),
+    ('label_id', '<i4'),
+    ('cords', '<i4', (4,)),
+    ('euclidean_intensity', '<f4'),
+    ('template_matching_conf', '<f4'),
+    ('yolo_conf', '<f4'),
+    ('association', 'u1'),
+])
+
+_MAGIC = b'VFTRKLOG'
+_VERSION = 1
+_HEADER_SIZE = 4096
+
+
+def _read_header(fh):
+    """
+    Read the header of a track log.
+    :param fh: The file, positioned at its start.
+    :return: The header metadata dictionary.
+    """
+    header = fh.read(_HEADER_SIZE)
+
+    if len(header) < _HEADER_SIZE or not header.startswith(_MAGIC):
+        raise ValueError("Not a VisionForge track log")
+
+    metadata = json.loads(header[len(_MAGIC):].rstrip(b' \0'))
+
+    if metadata.get('version') != _VERSION or metadata.get('record_size') != TRACK_LOG_DTYPE.itemsize:
+        raise ValueError(f"Unsupported track log version: {metadata.get('version')!r}")
+
+    metadata['names'] = {int(class_id): label for class_id, label in metadata.get('names', {}).items()}
+
+    return metadata
+
+
+class TrackLogWriter:
+    def __init__(self, path: Union[str, Path], names=None, buffer_records: int = 4096):
+        """
+        Initialize the TrackLogWriter object: an append-only log of fixed-size records (TRACK_LOG_DTYPE) after a 4 KiB
+        header holding the labels. Assign it to Tracking.track_log to log every tracked box and every YOLO cycle. An
+        existing log is appended to, with the frames and track ids written shifted after the last ones logged, so that
+        an appended run continues the log as a longer video. The timestamps never decrease (a clock moved back is
+        clamped), so the frame and timestamp columns stay sorted for TrackLogReader.
+        :param path: The path of the log.
+        :type path: str or Path
+        :param names: The labels {class id: label}. Updated from the detections written.
+        :param buffer_records: The number of records buffered before they are written to the file.
+        """
+        self.path = Path(path)
+        self.buffer_records = buffer_records
+        self.names = dict(names or {})
+
+        self.__buffer = []
+        self.__buffered = 0
+        self.__lock = threading.Lock()
+
+        self.__frame_offset = 0
+        self.__track_offset = 0
+        self.__last_timestamp = -np.inf
+
+        if self.path.exists() and self.path.stat().st_size:
+            self.__fh = open(self.path, 'r+b')
+            self.names = {**_read_header(self.__fh)['names'], **self.names}
+
+            records = TrackLogReader(self.path).records
+            count = len(records)
+
+            if count:
+                self.__frame_offset = int(records['frame'][-1]) + 1
+                self.__track_offset = max(int(records['track_id'].max()) + 1, 0)
+                self.__last_timestamp = float(records['timestamp'][-1])
+
+            del records
+
+            # A record cut by an interrupted write is dropped, so the appended records stay aligned.
+            self.__fh.truncate(_HEADER_SIZE + count * TRACK_LOG_DTYPE.itemsize)
+            self.__fh.seek(0, os.SEEK_END)
+        else:
+            self.__fh = open(self.path, 'w+b')
+            self.__write_header()
+            self.__fh.seek(_HEADER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_results(self, frame, results, detection_frame=-1, timestamp=None):
+        """
+        Log the results of one tracked frame. The records must be written in frame order.
+        :param frame: The 0-based index of the frame.
+        :param results: The results of Tracking.predict (list of dictionaries or RESULT_DTYPE array).
+        :param detection_frame: The index of the frame the boxes were detected on.
+        :param timestamp: The time of the frame (seconds). When None, time.time().
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        records = np.zeros(len(results), dtype=TRACK_LOG_DTYPE)
+
+        records['frame'] = frame
+        records['detection_frame'] = detection_frame
+        records['timestamp'] = timestamp
+        records['kind'] = TRACK
+
+        if isinstance(results, np.ndarray):
+            for field in ('track_id', 'label_id', 'cords', 'euclidean_intensity', 'template_matching_conf',
+                          'yolo_conf'):
+                records[field] = results[field]
+        else:
+            for record, result in zip(records, results):
+                record['track_id'] = result['track_id']
+                record['label_id'] = result['label_id']
+                record['cords'] = result['cords']
+                record['euclidean_intensity'] = result['euclidean_intensity']
+                record['template_matching_conf'] = result['template_matching_conf']
+                record['yolo_conf'] = result['yolo_conf']
+
+        with self.__lock:
+            self.__append(records)
+
+    def write_detections(self, frame, detection_frame, detections, assignments, names=None, timestamp=None):
+        """
+        Log the detections of one YOLO cycle. The records must be written in frame order: Tracking writes a cycle just
+        before the results of the first frame tracked with it.
+        :param frame: The index of the first frame tracked with the detections.
+        :param detection_frame: The index of the frame the detector ran on.
+        :param detections: The (xyxy, confidences, class_ids) tuple.
+        :param assignments: The (track_ids, associations) tuple: the track and the association of each detection.
+        :param names: The labels {class id: label} of the detector.
+        :param timestamp: The time of the frame (seconds). When None, time.time().
+        """
+        xyxy, confidences, class_ids = detections
+        track_ids, associations = assignments
+        records = np.zeros(max(len(xyxy), 1), dtype=TRACK_LOG_DTYPE)
+
+        records['frame'] = frame
+        records['detection_frame'] = detection_frame
+        records['timestamp'] = time.time() if timestamp is None else timestamp
+        records['kind'] = DETECTION
+
+        if len(xyxy):
+            records['track_id'] = track_ids
+            records['label_id'] = class_ids
+            records['association'] = associations
+            records['cords'] = np.asarray(xyxy).astype(int)
+            records['yolo_conf'] = confidences
+        else:
+            records['track_id'] = -1
+            records['label_id'] = -1
+            records['association'] = FILTERED
+
+        with self.__lock:
+            if names:
+                self.names.update(names)
+
+            self.__append(records)
+
+    def flush(self):
+        """
+        Write the buffered records and the header to the file.
+        """
+        with self.__lock:
+            self.__write_buffer()
+            self.__write_header()
+            self.__fh.seek(0, os.SEEK_END)
+            self.__fh.flush()
+
+    def close(self):
+        """
+        Flush and close the log.
+        """
+        if self.__fh.closed:
+            return
+
+        self.flush()
+        self.__fh.close()
+
+    def __append(self, records):
+        records['frame'] += self.__frame_offset
+        records['detection_frame'][records['detection_frame'] >= 0] += self.__frame_offset
+        records['track_id'][records['track_id'] >= 0] += self.__track_offset
+
+        records['timestamp'] = np.maximum(records['timestamp'], self.__last_timestamp)
+        self.__last_timestamp = records['timestamp'].max(initial=self.__last_timestamp)
+
+        self.__buffer.append(records)
+        self.__buffered += len(records)
+
+        if self.__buffered >= self.buffer_records:
+            self.__write_buffer()
+
+    def __write_buffer(self):
+        if self.__buffer:
+            self.__fh.write(np.concatenate(self.__buffer).tobytes())
+            self.__buffer = []
+            self.__buffered = 0
+
+    def __write_header(self):
+        metadata = json.dumps({'version': _VERSION, 'record_size': TRACK_LOG_DTYPE.itemsize,
+                               'names': {str(class_id): label for class_id, label in self.names.items()}})
+        header = _MAGIC + metadata.encode('utf-8')
+
+        if len(header) > _HEADER_SIZE:
+            raise ValueError("Track log labels do not fit in the header")
+
+        self.__fh.seek(0)
+        self.__fh.write(header.ljust(_HEADER_SIZE, b' '))
+
+
+class TrackLogReader:
+    def __init__(self, path: Union[str, Path]):
+        """
+        Initialize the TrackLogReader object. The records are memory-mapped: slicing by frame or time range touches
+        only the pages of the slice, and a scan by track id reads the log in chunks.
+        :param path: The path of the log.
+        :type path: str or Path
+        """
+        self.path = Path(path)
+
+        with open(self.path, 'rb') as fh:
+            self.names = _read_header(fh)['names']
+
+        count = (self.path.stat().st_size - _HEADER_SIZE) // TRACK_LOG_DTYPE.itemsize
+
+        if count:
+            self.records = np.memmap(self.path, dtype=TRACK_LOG_DTYPE, mode='r', offset=_HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=TRACK_LOG_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def frames(self, start=None, stop=None, kind=TRACK):
+        """
+        Get the records of a range of frames.
+        :param start: The first frame index (None for the first frame).
+        :param stop: The frame index after the last one (None for the end of the log).
+        :param kind: TRACK, DETECTION or None for both.
+        :return: Record array (TRACK_LOG_DTYPE).
+        """
+        return self.__slice('frame', start, stop, kind)
+
+    def time_range(self, start=None, stop=None, kind=TRACK):
+        """
+        Get the records of a time range.
+        :param start: The first timestamp, in seconds (None for the start of the log).
+        :param stop: The timestamp after the range (None for the end of the log).
+        :param kind: TRACK, DETECTION or None for both.
+        :return: Record array (TRACK_LOG_DTYPE).
+        """
+        return self.__slice('timestamp', start, stop, kind)
+
+    def track(self, track_id, chunk_records: int = 1 << 20):
+        """
+        Get the records of one track.
+        :param track_id: The track id.
+        :param chunk_records: The number of records scanned at once.
+        :return: Record array (TRACK_LOG_DTYPE), in frame order.
+        """
+        selected = [chunk[chunk['track_id'] == track_id] for chunk in self.__chunks(chunk_records)]
+
+        return np.concatenate(selected) if selected else np.zeros(0, dtype=TRACK_LOG_DTYPE)
+
+    def detections(self, chunk_records: int = 1 << 20):
+        """
+        Iterate over the logged YOLO cycles, in frame order.
+        :param chunk_records: The number of records scanned at once.
+        :return: Generator of (frame, detection_frame, (xyxy, confidences, class_ids), (track_ids, associations))
+                 tuples, with the detections in the format of Detector.detect.
+        """
+        carry = np.zeros(0, dtype=TRACK_LOG_DTYPE)
+
+        for chunk in self.__chunks(chunk_records):
+            records = np.concatenate([carry, chunk[chunk['kind'] == DETECTION]])
+
+            if not len(records):
+                continue
+
+            # The last cycle of the chunk may continue in the next one.
+            cycles = self.__split_cycles(records)
+            carry = cycles.pop()
+
+            yield from (self.__cycle(cycle) for cycle in cycles)
+
+        if len(carry):
+            yield from (self.__cycle(cycle) for cycle in self.__split_cycles(carry))
+
+    def close(self):
+        """
+        Release the memory map.
+        """
+        self.records = np.zeros(0, dtype=TRACK_LOG_DTYPE)
+
+    def __slice(self, field, start, stop, kind):
+        column = self.records[field]
+        first = 0 if start is None else int(np.searchsorted(column, start, side='left'))
+        last = len(column) if stop is None else int(np.searchsorted(column, stop, side='left'))
+        records = np.array(self.records[first: last])
+
+        return records if kind is None else records[records['kind'] == kind]
+
+    def __chunks(self, chunk_records):
+        for start in range(0, len(self.records), chunk_records):
+            yield np.array(self.records[start: start + chunk_records])
+
+    @staticmethod
+    def __split_cycles(records):
+        boundaries = np.flatnonzero((np.diff(records['frame']) != 0) | (np.diff(records['detection_frame']) != 0)) + 1
+
+        return np.split(records, boundaries)
+
+    @staticmethod
+    def __cycle(records):
+        frame, detection_frame = int(records['frame'][0]), int(records['detection_frame'][0])
+        records = records[records['label_id'] >= 0]
+
+        return frame, detection_frame, (records['cords'].astype(np.float32).reshape(-1, 4),
+                                        records['yolo_conf'].astype(np.float32), records['label_id'].astype(np.int32)), \
+            (records['track_id'].astype(np.int64), records['association'].astype(np.uint8))
@@ -1,25 +1,41 @@
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Union
 import numpy as np
 import cv2
-import torch
-from ultralytics import YOLO
-from .OpencvProcessing import OpencvProcessing
+from .FrameBuffer import FrameBufferPool
+from .OpencvProcessing import OpencvProcessing, RESULT_DTYPE
 from .YOLOProcessing import YOLOProcessing
+from .Detectors import as_detector, load_detector
+from .TrackLifecycle import TrackLifecycle, DELETED
+from .TrackLog import TrackLogReader
+from .StreamPipeline import StreamPipeline
 from .Exceptions import FrameNotFound
 
 
 class Tracking:
-    shared_frame = None
-    shared_boxes = {}
-
-    def __init__(self, model_path: Union[str, Path] = "yolov8n.pt"):
+    def __init__(self, model_path: Union[str, Path, None] = "yolov8n.pt", model=None, scheduler=None,
+                 detector_backend: str = "thread"):
         """
         Initialize the Tracking object.
-        :param model_path: The path to the YOLO model.
-        :type model_path: str or Path
+        :param model_path: The path to the model: an ultralytics model, or an exported ONNX model run on ONNX Runtime or
+                           cv2.dnn without torch (see load_detector). None loads no model; the boxes then come only
+                           from run_detection (tests, benchmarks and replays).
+        :type model_path: str or Path or None
+        :param model: An already loaded Detector (see Detectors) or YOLO model, possibly shared with other Tracking
+                      objects. When given, model_path is not loaded.
+        :param scheduler: The object that runs the detections of this Tracking (see BatchDetectionScheduler). When None,
+                          a detection thread owned by this object is used.
+        :param detector_backend: "thread" runs the detector inside this process; "process" runs it on a separate process
+                                 (see ProcessDetector), leaving the GIL to the Template Matching.
         """
+        self.shared_frame = None
+        self.shared_boxes = {}
+        self.names = {}
+        self.frame_pool = FrameBufferPool()
+
         self.horizontal_tracking = True
         self.vertical_tracking = True
         self.horizontal_expansion = 100
@@ -29,83 +45,437 @@ class Tracking:
         self.match_template_confidence = 0.1
         self.euclidean_distance = 0.1
 
+        # A new YOLO box keeps the id of the tracked box whose larger template contains it, choosing the highest IoU
+        # first ("greedy") or the best overall assignment ("hungarian", requires scipy). From
+        # association_grid_threshold (detections x tracks) pairs on, the candidates come from a spatial grid index.
+        self.association_method = "greedy"
+        self.association_grid_threshold = 4096
+
+        # "off" matches the boxes one after another, "on" matches all of them at once on a thread pool and "auto"
+        # uses the thread pool only from parallel_matching_threshold boxes on.
+        self.parallel_matching = "off"
+        self.parallel_matching_threshold = 8
+        self.matching_workers = None
+
+        # Time between the start of two YOLO cycles: 0 runs them back-to-back, a number of seconds fixes the period
+        # and "auto" follows the measured YOLO latency (yolo_latency), divided by yolo_duty_cycle (0.5 keeps the
+        # detector busy half of the time; 1 is the same as 0). A scheduler paces the detections of each Tracking the
+        # same way. The detection thread stops by itself when no new frame arrives for idle_timeout seconds (None waits
+        # forever) and the next predict starts it again.
+        self.yolo_period = "auto"
+        self.yolo_duty_cycle = 0.5
+        self.idle_timeout = 5.0
+
+        # Any object with a record(stage, value) method (see Instrumentation) receives the per-stage timings, and any
+        # object with write_results/write_detections methods (see TrackLogWriter) every tracked frame and YOLO cycle.
+        self.instrumentation = None
+        self.track_log = None
+
+        self.yolo_latency = None
+        self.detection_error = None
+        self.frame_sequence = 0
+        self.detection_sequence = 0
+
+        # The last YOLO cycle of the detector and the last one applied to the tracks by predict.
+        self.__detection_cycle = None
+        self.__applied_cycle = None
+
         self.__thread_yolo_condition = threading.Condition()
-        self.__thread_yolo = threading.Thread(target=self.start_tracking_thread)
+        self.__thread_yolo = threading.Thread(target=self.start_tracking_thread, daemon=True)
         self.__thread_yolo_stop_flag = False
+        self.__thread_yolo_running = False
+        self.__detection_ready = threading.Event()
+        self.__scheduler = scheduler
 
-        self.__model_path = str(model_path).strip()
+        self.__model_path = str(model_path).strip() if model_path is not None else None
 
         self.template_matching_method = cv2.TM_CCORR_NORMED
 
+        # The template is searched over the larger image at a coarse pyramid level (1/2 ** level), then refined level by
+        # level within 1 + pyramid_refine_margin pixels of the match above, with template_matching_method at full
+        # resolution. "auto" picks the coarsest level (at least 1, up to max_pyramid_level) at which the template is
+        # still min_pyramid_template_size pixels wide. The coarser levels use pyramid_coarse_method: the squared
+        # difference keeps the blurred pyramid levels apart much better than TM_CCORR_NORMED.
+        self.pyramid_levels = "auto"
+        self.pyramid_coarse_method = cv2.TM_SQDIFF_NORMED
+        self.max_pyramid_level = 3
+        self.min_pyramid_template_size = 8
+        self.pyramid_refine_margin = 2
+        self.subpixel_refinement = False
+
+        # With adaptive_search, each box has a constant velocity Kalman filter and its larger template is centered on
+        # the predicted position and sized from the prediction uncertainty, instead of the fixed expansion. The
+        # horizontal_expansion/vertical_expansion become the maximum expansion.
+        self.adaptive_search = False
+        self.search_window_sigma = 3.0
+        self.min_search_expansion = 8
+        self.motion_process_noise = 1.0
+        self.motion_measurement_noise = 1.0
+
+        # With change_gating, a box whose region did not change since its last match (mean absolute gray difference up
+        # to change_threshold) keeps its coordinates without Template Matching; its result has 'skipped' = True.
+        self.change_gating = False
+        self.change_threshold = 3.0
+
+        # Track lifecycle: a new track is "tentative" until it is detected track_min_hits times, then "confirmed"; only
+        # confirmed tracks are reported. A track not found by the Template Matching is "lost" and, after track_max_age
+        # frames lost, "deleted" (removed from shared_boxes, no longer matched). A confirmed track missed by a YOLO
+        # cycle survives track_max_detection_misses cycles (0: every YOLO cycle replaces the tracks).
+        self.track_min_hits = 1
+        self.track_max_age = 5
+        self.track_max_detection_misses = 0
+
+        # Template refresh: None keeps the detection crop; "blend" blends the matched region into the template
+        # (exponential moving average with template_update_rate) on matches of template_blend_confidence or more;
+        # "recrop" replaces it by the crop of a new detection of template_recrop_confidence or more. When the templates
+        # of this stream exceed template_memory_limit bytes (None for no limit), the lost, then tentative, then least
+        # recently seen tracks are deleted.
+        self.template_update = None
+        self.template_update_rate = 0.1
+        self.template_blend_confidence = 0.95
+        self.template_recrop_confidence = 0.6
+        self.template_memory_limit = 64 * 2 ** 20
+
         self.__opencvProcessing = OpencvProcessing(self)
         self.__yoloProcessing = YOLOProcessing(self)
-        self.__past_frame = None;
+        self.__lifecycle = TrackLifecycle(self)
+        self.__matching_pool = None
 
-        self.__init_yolo_model()
+        self.detector = None
+        self.__owns_detector = False
+
+        if detector_backend not in ("thread", "process"):
+            raise ValueError(f"Unknown detector backend: {detector_backend!r}")
+
+        if model is not None:
+            self.detector = as_detector(model)
+        elif self.__model_path is None:
+            # Without a detector there is nothing to wait for: predict tracks the boxes given to run_detection.
+            self.__detection_ready.set()
+        elif detector_backend == "process":
+            from .ProcessDetector import ProcessDetector
+
+            self.detector = ProcessDetector(self.__model_path)
+            self.__owns_detector = True
+        else:
+            self.__init_yolo_model()
 
     def __init_yolo_model(self):
         """
-        Initialize the YOLO model.
+        Initialize the detector (torch and ultralytics are imported only for ultralytics models).
         """
-        model = YOLO(self.__model_path)
-        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-        model.to(device)
+        self.detector = load_detector(self.__model_path)
+        self.__owns_detector = True
 
-        self.model = model
+    @property
+    def model(self):
+        """
+        The ultralytics model of the detector, or None for the other detectors.
+        """
+        return getattr(self.detector, 'model', None)
 
     def start_tracking_thread(self):
         """
-        Start the tracking thread.
+        Start the tracking thread. A YOLO cycle runs when predict publishes a new frame (signalled by frame_sequence)
+        and the yolo_period since the previous cycle is over.
         """
-        while not self.__thread_yolo_stop_flag:
-            if self.__past_frame is not None and np.array_equal(self.__past_frame, Tracking.shared_frame):
-                self.__thread_yolo_stop_flag = True
-                break
+        last_sequence = 0
 
-            self.__past_frame = Tracking.shared_frame
-            boxes_dict = self.__yoloProcessing()
-            Tracking.shared_boxes = boxes_dict
+        while True:
+            with self.__thread_yolo_condition:
+                new_frame = self.__thread_yolo_condition.wait_for(
+                    lambda: self.__thread_yolo_stop_flag or self.frame_sequence != last_sequence, self.idle_timeout)
+
+                # Idle or stopped; marked under the lock so that a frame published from now on starts a new thread.
+                if not new_frame or self.__thread_yolo_stop_flag:
+                    self.__thread_yolo_running = False
+                    break
+
+                slot = self.frame_pool.acquire_latest()
+                last_sequence = slot.sequence
+
+            start = time.perf_counter()
+
+            try:
+                self.run_detection(slot.frame, sequence=last_sequence)
+            except Exception as error:
+                self.detection_failed(error)
+            finally:
+                self.frame_pool.release(slot)
 
             with self.__thread_yolo_condition:
-                self.__thread_yolo_condition.notify()
+                self.__thread_yolo_condition.wait_for(lambda: self.__thread_yolo_stop_flag,
+                                                      start + self.detection_period() - time.perf_counter())
+
+    def detection_period(self):
+        """
+        Calculate the time between the start of two YOLO cycles. A BatchDetectionScheduler follows it too.
+        :return: The period in seconds.
+        """
+        if self.yolo_period == "auto":
+            return (self.yolo_latency or 0) / self.yolo_duty_cycle
+
+        return self.yolo_period or 0
+
+    def run_detection(self, frame=None, detections=None, sequence=None, assignments=None, detector_latency=0):
+        """
+        Run one YOLO cycle. Its boxes replace the ones tracked by OpenCV from the next predict on.
+        :param frame: The frame the detection belongs to. When None, the last published frame is used.
+        :param detections: The (xyxy, confidences, class_ids) tuple already computed for the frame (e.g. by a batched
+                           detection). When None, the detector is run on the frame.
+        :param sequence: The frame_sequence of the frame. When None, the last published one.
+        :param assignments: The (track_ids, associations) tuple of a logged cycle (see TrackLog), used instead of
+                            associating the detections with the tracks.
+        :param detector_latency: The time, in seconds, the detector took to compute detections given by the caller (e.g.
+                                 the batched detection of a scheduler). It is part of the cycle latency.
+        """
+        start = time.perf_counter() - detector_latency
+
+        frame = self.shared_frame if frame is None else frame
 
-    def predict(self, frame=None):
+        if detections is None:
+            detections = self.detector.detect([frame], self.yolo_confidence)[0]
+
+        cycle = self.__yoloProcessing(frame, detections, assignments)
+        cycle['sequence'] = self.frame_sequence if sequence is None else sequence
+        self.__detection_cycle = cycle
+
+        # Exponential moving average of the YOLO latency, used by yolo_period "auto".
+        latency = time.perf_counter() - start
+        self.yolo_latency = latency if self.yolo_latency is None else 0.8 * self.yolo_latency + 0.2 * latency
+
+        if self.instrumentation is not None:
+            self.instrumentation.record('detector_cycle', latency)
+
+        self.__detection_ready.set()
+
+    def detection_failed(self, error):
+        """
+        Report a YOLO cycle whose detector raised. The next predict raises the error; the following ones keep tracking
+        the current boxes until a cycle succeeds.
+        :param error: The exception raised by the detector.
+        """
+        self.detection_error = error
+        self.__detection_ready.set()
+
+    def stop(self):
+        """
+        Ask the detection thread to stop. It finishes the current YOLO cycle, if any.
+        """
+        with self.__thread_yolo_condition:
+            self.__thread_yolo_stop_flag = True
+            self.__thread_yolo_condition.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait for the detection thread to finish.
+        :param timeout: The maximum time to wait, in seconds. None waits until the thread finishes.
+        """
+        if self.__thread_yolo.is_alive() and self.__thread_yolo is not threading.current_thread():
+            self.__thread_yolo.join(timeout)
+
+    def close(self):
+        """
+        Stop the detection thread and release the Template Matching thread pool and the detector loaded by this object.
+        """
+        self.stop()
+        self.join()
+
+        if self.__matching_pool is not None:
+            self.__matching_pool.shutdown()
+            self.__matching_pool = None
+
+        if self.__owns_detector:
+            self.detector.close()
+            self.__owns_detector = False
+
+    def predict(self, frame=None, as_array=False):
         """
         Predict the objects in the frame.
         :param frame: The input frame.
-        :param conf: Yolo confidence.
-        :return: List of dictionaries containing the results.
+        :param as_array: Return one NumPy record array (RESULT_DTYPE) instead of a dictionary per box.
+        :return: List of dictionaries containing the results, or the record array.
         """
         if frame is None:
-            self.__thread_yolo_stop_flag = True
+            self.stop()
             raise FrameNotFound("Error: Frame Not Found")
 
-        original_frame_copy = frame.copy()
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
 
-        Tracking.shared_frame = original_frame_copy
+        # The detector gets a copy in a preallocated slot of the frame pool; the tracker reads the frame directly.
+        with self.__thread_yolo_condition:
+            self.frame_sequence += 1
+            sequence = self.frame_sequence
+            self.shared_frame = self.frame_pool.publish(frame, sequence).frame
+            self.__thread_yolo_condition.notify_all()
 
-        if not self.__thread_yolo.is_alive() and not self.__thread_yolo_stop_flag:
-            self.__thread_yolo.start()
+            # The detection thread starts with the first frame, and again after it stopped for idle_timeout.
+            if self.__scheduler is None and self.detector is not None and not self.__thread_yolo_stop_flag and \
+                    not (self.__thread_yolo_running and self.__thread_yolo.is_alive()):
+                self.__thread_yolo = threading.Thread(target=self.start_tracking_thread, daemon=True)
+                self.__thread_yolo_running = True
+                self.__thread_yolo.start()
 
-            with self.__thread_yolo_condition:
-                self.__thread_yolo_condition.wait()
+        if self.__scheduler is not None:
+            self.__scheduler.notify_frame(self)
+
+        detection_thread = self.__thread_yolo if self.__scheduler is None else self.__scheduler
+
+        while not self.__detection_ready.wait(0.1):
+            if not detection_thread.is_alive():
+                break
+
+        error, self.detection_error = self.detection_error, None
+
+        if error is not None:
+            raise error
+
+        # A new YOLO cycle is applied here, between two frames, so the tracks are only modified by this thread.
+        cycle = self.__detection_cycle
+
+        if cycle is not None and cycle is not self.__applied_cycle:
+            self.shared_boxes, assignments = self.__yoloProcessing.apply(cycle)
+            self.detection_sequence = cycle['sequence']
+            self.__applied_cycle = cycle
+        else:
+            cycle = None
+
+        boxes_dict = self.shared_boxes
+        boxes = [box for box in list(boxes_dict.values()) if box.get('state') != DELETED]
+        detection_sequence = self.detection_sequence
+
+        if instrumentation is not None:
+            instrumentation.record('staleness', sequence - detection_sequence)
+            preprocess_start = time.perf_counter()
 
-        results = []
+        frame_data = self.__opencvProcessing.preprocess_frame(frame)
 
-        for box in Tracking.shared_boxes.values():
-            result = self.__opencvProcessing(original_frame_copy, box)
+        if instrumentation is not None:
+            instrumentation.record('preprocess', time.perf_counter() - preprocess_start)
 
-            if result:
-                results.append(result)
+        if self.__use_parallel_matching(len(boxes)):
+            matches = self.__get_matching_pool().map(lambda box: self.__opencvProcessing(frame_data, box, as_array),
+                                                     boxes)
+        else:
+            matches = (self.__opencvProcessing(frame_data, box, as_array) for box in boxes)
+
+        if as_array:
+            results = np.array([result for result in matches if result], dtype=RESULT_DTYPE)
+        else:
+            results = [result for result in matches if result]
+
+        # Deleted tracks leave the box dictionary.
+        self.__lifecycle.prune(boxes_dict)
+
+        if self.track_log is not None:
+            # A cycle is logged just before the results of the first frame tracked with it.
+            if cycle is not None:
+                self.track_log.write_detections(sequence - 1, cycle['sequence'] - 1, cycle['detections'], assignments,
+                                                cycle['names'])
+
+            self.track_log.write_results(sequence - 1, results, detection_sequence - 1)
+
+        if instrumentation is not None:
+            if self.change_gating:
+                instrumentation.record('skipped', int(results['skipped'].sum()) if as_array else
+                                       sum(result['skipped'] for result in results))
+
+            instrumentation.record('predict', time.perf_counter() - start)
 
         return results
 
-    def generate_cords_large_template(self, cords):
+    def track_stream(self, source, annotate=None, queue_size: int = 4, drop_policy: str = "block"):
+        """
+        Track a whole video stream, with capture/decode, tracking and annotate/encode overlapped on their own threads.
+        :param source: A video path, URL or camera index, an opened cv2.VideoCapture or any iterable of frames.
+        :param annotate: Optional callable (frame, results) -> output run on its own stage.
+        :param queue_size: The maximum number of frames waiting between two stages.
+        :param drop_policy: "block", "drop_oldest" or "latest" (see StreamPipeline).
+        :return: The StreamPipeline; iterate over it to get, per frame, a dictionary with 'index', 'timestamp',
+                 'frame', 'results' and 'output'.
+        """
+        return StreamPipeline(self, source, annotate, queue_size, drop_policy)
+
+    def replay(self, frames, log, as_array=False):
+        """
+        Track a logged video with the detections of its track log instead of a detector, for reproducible tracker-only
+        runs. Each logged YOLO cycle replaces the boxes on the frame it was first used on when logged, with the
+        templates cropped from the frame it was detected on and the logged track ids instead of a new association, so
+        the detector latency and the association of the logged run are reproduced.
+        :param frames: The frames of the logged video, from its first frame (any iterable of frames).
+        :param log: The TrackLogReader, or the path of the track log.
+        :param as_array: Return one NumPy record array (RESULT_DTYPE) per frame instead of a list of dictionaries.
+        :return: Generator of the predict results of each frame.
+        """
+        if self.detector is not None or self.__scheduler is not None:
+            raise ValueError("Replay needs a Tracking without a detector (model_path=None)")
+
+        if not isinstance(log, TrackLogReader):
+            log = TrackLogReader(log)
+
+        self.names = {**log.names, **self.names}
+        offset = self.frame_sequence
+        cycles = log.detections()
+        next_cycle = next(cycles, None)
+        waiting = []
+
+        for index, frame in enumerate(frames):
+            # Keep the frame a cycle was detected on until the frame the cycle is applied on.
+            while next_cycle is not None and next_cycle[1] <= index:
+                cycle_frame, detection_frame, detections, assignments = next_cycle
+                source = frame.copy() if cycle_frame > index else frame
+                waiting.append((cycle_frame, detection_frame, detections, assignments, source))
+                next_cycle = next(cycles, None)
+
+            for cycle_frame, detection_frame, detections, assignments, source in waiting:
+                if cycle_frame <= index:
+                    self.run_detection(source, detections, offset + detection_frame + 1, assignments)
+
+            waiting = [cycle for cycle in waiting if cycle[0] > index]
+
+            yield self.predict(frame, as_array)
+
+    def __use_parallel_matching(self, boxes_count):
+        """
+        Check whether the boxes of the current frame are matched on the thread pool.
+        :param boxes_count: The number of boxes in the frame.
+        :return: True to use the thread pool.
+        """
+        if self.parallel_matching == "on":
+            return boxes_count > 1
+        if self.parallel_matching == "auto":
+            return boxes_count >= self.parallel_matching_threshold
+        if self.parallel_matching == "off":
+            return False
+
+        raise ValueError(f"Unknown parallel matching mode: {self.parallel_matching!r}")
+
+    def __get_matching_pool(self):
+        """
+        Create the Template Matching thread pool on first use. cv2.matchTemplate and cv2.cvtColor release the GIL, so
+        the boxes are really matched at the same time.
+        :return: The thread pool.
+        """
+        if self.__matching_pool is None:
+            self.__matching_pool = ThreadPoolExecutor(max_workers=self.matching_workers,
+                                                      thread_name_prefix="VisionForgeMatching")
+
+        return self.__matching_pool
+
+    def generate_cords_large_template(self, cords, motion=None):
         """
         Generate the coordinates of a larger template.
         :param cords: The coordinates of the bounding box.
+        :param motion: The KalmanMotionModel of the box, already advanced to the current frame. When given, the larger
+                       template is centered on the predicted position and expanded by search_window_sigma standard
+                       deviations, between min_search_expansion and horizontal_expansion/vertical_expansion.
         :return: The adjusted coordinates of the bounding box.
         """
+        if motion is not None:
+            return self.__generate_cords_predicted_template(cords, motion)
+
         x_min_adjusted = cords[0] - (self.horizontal_tracking * self.horizontal_expansion)
         y_min_adjusted = cords[1] - (self.vertical_tracking * self.vertical_expansion)
 
@@ -113,3 +483,30 @@ class Tracking:
         y_max_adjusted = cords[3] + (self.vertical_tracking * self.vertical_expansion)
 
         return x_min_adjusted, y_min_adjusted, x_max_adjusted, y_max_adjusted
+
+    def __generate_cords_predicted_template(self, cords, motion):
+        """
+        Generate the coordinates of a larger template around the position predicted by the motion model.
+        :param cords: The coordinates of the bounding box.
+        :param motion: The KalmanMotionModel of the box.
+        :return: The adjusted coordinates of the bounding box.
+        """
+        (center_x, center_y), (std_x, std_y) = motion.center, motion.center_std
+
+        if self.horizontal_tracking:
+            half_width = (cords[2] - cords[0]) / 2
+            expansion = min(max(self.search_window_sigma * std_x, self.min_search_expansion), self.horizontal_expansion)
+            x_min_adjusted = int(round(center_x - half_width - expansion))
+            x_max_adjusted = int(round(center_x + half_width + expansion))
+        else:
+            x_min_adjusted, x_max_adjusted = cords[0], cords[2]
+
+        if self.vertical_tracking:
+            half_height = (cords[3] - cords[1]) / 2
+            expansion = min(max(self.search_window_sigma * std_y, self.min_search_expansion), self.vertical_expansion)
+            y_min_adjusted = int(round(center_y - half_height - expansion))
+            y_max_adjusted = int(round(center_y + half_height + expansion))
+        else:
+            y_min_adjusted, y_max_adjusted = cords[1], cords[3]
+
+        return x_min_adjusted, y_min_adjusted, x_max_adjusted, y_max_adjusted
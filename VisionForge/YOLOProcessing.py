@@ -1,14 +1,22 @@
+import cv2
+import numpy as np
 from VisionForge import Tracking
+from .Association import Association
+from .TrackLifecycle import TrackLifecycle, LOST, DELETED
+from .TrackLog import NEW, MATCHED, RESTARTED, FILTERED
 
 
 class YOLOProcessing:
     def __init__(self, vf: 'Tracking'):
         self.__visionForge = vf
+        self.__association = Association(vf)
+        self.__lifecycle = TrackLifecycle(vf)
+        self.__next_key = 0
 
         self.__yolo_in_ram = False
 
     def __call__(self, *args, **kwargs):
-        return self.detection()
+        return self.detection(*args, **kwargs)
 
     def find_object(self, new_cords):
         """
@@ -16,58 +24,150 @@ class YOLOProcessing:
         :param new_cords: The new coordinates of the bounding box.
         :return: The dictionary containing the bounding box information.
         """
-        for box in self.__visionForge.shared_boxes.values():
-            larger_cords = self.__visionForge.generate_cords_large_template(box['cords'])
+        box = self.__association([new_cords], list(self.__visionForge.shared_boxes.values()))[0]
 
-            if new_cords[0] >= larger_cords[0] and new_cords[1] >= larger_cords[1] and \
-                    new_cords[2] <= larger_cords[2] and new_cords[3] <= larger_cords[3]:
-                return box
+        return box if box is not None else []
 
-        return []
-
-    def detection(self):
+    def detection(self, frame=None, detections=None, assignments=None):
         """
-        Perform object detection using YOLO.
-        :return: Dictionary containing the bounding box information.
+        Perform object detection using the detector of the Tracking and associate the detections with the tracks. The
+        tracks are not modified here: the Tracking applies the cycle (see apply) on the first frame tracked with it.
+        :param frame: The input frame. When None, the last frame shared by the Tracking is used.
+        :param detections: The (xyxy, confidences, class_ids) tuple of the frame, already computed (e.g. by a batched
+                           detection). When None, the detector is run on the frame.
+        :param assignments: The (track_ids, associations) tuple of a logged cycle (see TrackLog), used instead of
+                            associating the detections with the tracks.
+        :return: Dictionary containing the YOLO cycle.
         """
-        model = self.__visionForge.model
-        shared_frames = self.__visionForge.shared_frame
+        shared_frames = self.__visionForge.shared_frame if frame is None else frame
         self.__visionForge.last_yolo_shared_frame = shared_frames
 
-        boxes_dict = {}
+        detector = self.__visionForge.detector
+
+        if detections is None:
+            detections = detector.detect([shared_frames], self.__visionForge.yolo_confidence)[0]
+
+        xyxy, confidences, class_ids = detections
+        names = detector.names if detector is not None else self.__visionForge.names
+
+        # A batched detection is computed with the lowest confidence of the batch, so each Tracking filters its own.
+        self.__visionForge.names = names
+
+        # Boxes are clipped to the frame; those left without area (e.g. in the letterbox padding) cannot be cropped.
+        height, width = shared_frames.shape[:2]
+        xyxy = np.clip(np.asarray(xyxy).reshape(-1, 4).astype(int), 0, [width, height, width, height])
+        keep = (confidences >= self.__visionForge.yolo_confidence) & (xyxy[:, 2] > xyxy[:, 0]) & \
+            (xyxy[:, 3] > xyxy[:, 1])
+        indices = np.flatnonzero(keep).tolist()
+        xyxy, confidences, class_ids = xyxy[keep], confidences[keep], class_ids[keep]
+
+        if assignments is None:
+            tracks = [box for box in self.__visionForge.shared_boxes.values() if box.get('state') != DELETED]
+            matches = self.__association(xyxy, tracks)
+            keys = [None] * len(indices)
+        else:
+            track_ids, associations = assignments
+            matches = [self.__visionForge.shared_boxes.get(int(track_ids[index]))
+                       if associations[index] in (MATCHED, RESTARTED) else None for index in indices]
+            keys = [int(track_ids[index]) if associations[index] == NEW else None for index in indices]
+
+        # The templates are cropped now: the frame is released once the cycle is done.
+        rows = [{
+            'index': index,
+            'cords': cords,
+            'confidence': confidence,
+            'label_id': class_id,
+            'track': find_object,
+            'key': key,
+            'template': cv2.cvtColor(shared_frames[cords[1]: cords[3], cords[0]: cords[2]], cv2.COLOR_BGR2GRAY),
+        } for index, cords, confidence, class_id, find_object, key in zip(
+            indices, xyxy.tolist(), confidences.tolist(), class_ids.tolist(), matches, keys)]
 
-        result = model.predict(shared_frames, conf=self.__visionForge.yolo_confidence, verbose=False)[0]
-        boxes = result.boxes
+        if not self.__yolo_in_ram:
+            self.__yolo_in_ram = True
 
-        for i, box in enumerate(boxes):
-            cords = [int(x) for x in box.xyxy[0].tolist()]
+        return {'rows': rows, 'detections': detections, 'names': dict(names), 'frame_shape': shared_frames.shape}
 
-            find_object = self.find_object(cords)
+    def apply(self, cycle):
+        """
+        Apply a YOLO cycle to the tracks: the associated tracks are redetected, the other detections create tracks and
+        the tracks missed by the cycle survive up to track_max_detection_misses cycles. Called by the Tracking on the
+        first frame tracked with the cycle, so the tracks are only modified between two frames.
+        :param cycle: The YOLO cycle returned by detection.
+        :return: Tuple containing the dictionary with the bounding box information and the (track_ids, associations)
+                 of the detections (see TrackLog).
+        """
+        boxes_dict = {}
+        shared_boxes = self.__visionForge.shared_boxes
+        count = len(cycle['detections'][0])
+        track_ids = np.full(count, -1, dtype=np.int64)
+        associations = np.full(count, FILTERED, dtype=np.uint8)
+
+        for row in cycle['rows']:
+            box = row['track']
+
+            # A track deleted since the association is not revived: the detection creates a new one.
+            if box is not None and box.get('state') != DELETED and box['key'] not in boxes_dict:
+                restarted = self.__redetected(box, row, cycle['frame_shape'])
+                boxes_dict[box['key']] = box
+                track_ids[row['index']], associations[row['index']] = box['key'], RESTARTED if restarted else MATCHED
+                continue
 
-            if find_object:
-                key = find_object['key']
+            key = row['key']
 
-                if key >= i:
-                    boxes_dict[i] = find_object
-                else:
-                    box_temp = boxes_dict[key]
-                    boxes_dict[key] = find_object
-                    boxes_dict[i] = box_temp
-                continue
+            if key is None or key in boxes_dict or key in shared_boxes:
+                key = self.__next_key
 
-            label = result.names[box.cls[0].item()]
-            confidence = box.conf[0].item()
+            self.__next_key = max(self.__next_key, key + 1)
 
-            boxes_dict[i] = {
-                'key': i,
-                'label': label,
-                'confidence': confidence,
-                'cords': cords,
-                'original_cords_yolo': cords,
-                'template_image': shared_frames[cords[1]: cords[3], cords[0]: cords[2]],
+            boxes_dict[key] = {
+                'key': key,
+                'label': cycle['names'].get(row['label_id'], str(row['label_id'])),
+                'label_id': row['label_id'],
+                'confidence': row['confidence'],
+                'cords': row['cords'],
+                'original_cords_yolo': row['cords'],
+                'template_gray': row['template'],
             }
+            self.__lifecycle.created(boxes_dict[key])
+            track_ids[row['index']], associations[row['index']] = key, NEW
 
-        if not self.__yolo_in_ram:
-            self.__yolo_in_ram = True
+        # Confirmed tracks missed by this cycle survive up to track_max_detection_misses cycles.
+        for box in [box for box in shared_boxes.values() if box.get('state') != DELETED]:
+            if box['key'] not in boxes_dict and self.__lifecycle.missed_by_detector(box):
+                boxes_dict[box['key']] = box
+
+        return boxes_dict, (track_ids, associations)
+
+    def __redetected(self, box, row, frame_shape):
+        """
+        Update a track associated with a new detection. A lost track restarts from the detection; with template_update
+        "recrop", a detection of template_recrop_confidence or more replaces the template of the track by its crop,
+        keeping the tracked center. The new template is left in 'template_pending' and applied by the Template
+        Matching.
+        :param box: The dictionary containing the bounding box information.
+        :param row: The detection of the cycle (coordinates, confidence and template).
+        :param frame_shape: The shape of the frame of the detection.
+        :return: True when the track restarts from the detection.
+        """
+        vf = self.__visionForge
+        lost = box['state'] == LOST
+        cords, template = row['cords'], row['template']
+
+        self.__lifecycle.detected(box)
+
+        if lost:
+            box['template_pending'] = (template, cords, True)
+            return True
+
+        if vf.template_update != "recrop" or row['confidence'] < vf.template_recrop_confidence:
+            return False
+
+        tracked = box['cords']
+        width, height = cords[2] - cords[0], cords[3] - cords[1]
+        x1 = min(max((tracked[0] + tracked[2] - width) // 2, 0), frame_shape[1] - width)
+        y1 = min(max((tracked[1] + tracked[3] - height) // 2, 0), frame_shape[0] - height)
+
+        box['template_pending'] = (template, [x1, y1, x1 + width, y1 + height], False)
 
-        return boxes_dict
+        return False
@@ -3,3 +3,10 @@
 __version__ = "1.0.0"
 
 from VisionForge.Tracking import Tracking
+from VisionForge.MultiStreamTracking import MultiStreamTracking
+from VisionForge.BatchDetectionScheduler import BatchDetectionScheduler
+from VisionForge.StreamPipeline import StreamPipeline
+from VisionForge.OpencvProcessing import RESULT_DTYPE
+from VisionForge.Instrumentation import Instrumentation
+from VisionForge.Detectors import Detector, load_detector
+from VisionForge.TrackLog import TrackLogWriter, TrackLogReader
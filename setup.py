@@ -37,5 +37,6 @@ with open('README.md', 'r', encoding='utf-8') as fh:
         install_requires=['ultralytics~=8.0.118',
                           'opencv-python~=4.6.0.66',
                           'numpy~=1.23.5',
-                          'torch>=1.8.1']
+                          'torch>=1.8.1'],
+        extras_require={'onnx': ['onnxruntime']}
     )
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from VisionForge import Tracking
+from VisionForge.Association import Association
+
+
+def random_boxes(rng, count, size=(1280, 720)):
+    corners = rng.uniform(0, 1, (count, 2)) * np.subtract(size, 80)
+    sides = rng.uniform(10, 80, (count, 2))
+
+    return np.concatenate([corners, corners + sides], axis=1)
+
+
+@pytest.mark.parametrize('method', ['greedy', 'hungarian'])
+def test_grid_candidates_match_the_exhaustive_search(method):
+    if method == 'hungarian':
+        pytest.importorskip('scipy')
+
+    rng = np.random.default_rng(0)
+    tracking = Tracking(model_path=None)
+    tracking.association_method = method
+    association = Association(tracking)
+
+    for _ in range(20):
+        tracks = [{'cords': cords} for cords in random_boxes(rng, 60)]
+        jitter = rng.normal(0, 8, (60, 4))
+        detections = np.concatenate([[track['cords'] for track in tracks] + jitter, random_boxes(rng, 20)])
+
+        tracking.association_grid_threshold = np.inf
+        exhaustive = association(detections, tracks)
+        tracking.association_grid_threshold = 0
+        grid = association(detections, tracks)
+
+        assert any(track is not None for track in grid)
+        assert [id(track) for track in grid] == [id(track) for track in exhaustive]
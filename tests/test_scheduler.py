@@ -0,0 +1,139 @@
+import time
+import numpy as np
+import pytest
+from VisionForge import MultiStreamTracking, Tracking, Detector
+
+FRAME = np.random.default_rng(0).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+
+
+class ScriptedDetector(Detector):
+    names = {0: 'object'}
+
+    def __init__(self, script=()):
+        """
+        Detector whose first cycles follow the script: an exception is raised, anything else is returned as the
+        detections of every frame. The cycles after the script return one box.
+        """
+        self.script = list(script)
+        self.calls = 0
+
+    def detect(self, frames, confidence):
+        self.calls += 1
+        step = self.script.pop(0) if self.script else (np.array([[10, 10, 50, 50]], dtype=np.float32),
+                                                      np.array([0.9], dtype=np.float32),
+                                                      np.array([0], dtype=np.int32))
+
+        if isinstance(step, Exception):
+            raise step
+
+        return [step for _ in frames]
+
+
+@pytest.mark.parametrize('step', [RuntimeError("detector failed"), (None, None, None)])
+def test_failed_cycle_is_raised_once_and_detection_goes_on(step):
+    detector = ScriptedDetector([step])
+    streams = MultiStreamTracking(model=detector)
+    streams.add_stream('cam')
+
+    try:
+        with pytest.raises(Exception):
+            streams.predict('cam', FRAME)
+
+        for _ in range(50):
+            streams.predict('cam', FRAME)
+            time.sleep(0.01)
+
+        assert detector.calls > 1
+    finally:
+        streams.stop()
+
+
+def test_stream_added_after_stop_does_not_hang():
+    streams = MultiStreamTracking(model=ScriptedDetector())
+    streams.stop()
+    streams.add_stream('cam')
+
+    assert streams.predict('cam', FRAME) == []
+
+
+def test_boxes_without_area_are_dropped():
+    boxes = (np.array([[160, 5, 160, 40], [10, 10, 50, 50], [30, 30, 30.4, 60]], dtype=np.float32),
+             np.full(3, 0.9, dtype=np.float32), np.zeros(3, dtype=np.int32))
+    streams = MultiStreamTracking(model=ScriptedDetector([boxes]))
+    streams.add_stream('cam')
+
+    try:
+        results = streams.predict('cam', FRAME)
+    finally:
+        streams.stop()
+
+    assert [result['cords_yolo'] for result in results] == [[10, 10, 50, 50]]
+
+
+def predict_for(tracking, seconds):
+    deadline = time.perf_counter() + seconds
+
+    while time.perf_counter() < deadline:
+        tracking.predict(FRAME)
+        time.sleep(0.01)
+
+
+def test_scheduled_yolo_period_is_honoured():
+    detector = ScriptedDetector()
+    streams = MultiStreamTracking(model=detector)
+    streams.add_stream('cam').yolo_period = 0.4
+
+    try:
+        predict_for(streams['cam'], 1.0)
+    finally:
+        streams.stop()
+
+    assert 2 <= detector.calls <= 4
+
+
+def test_yolo_period_is_honoured():
+    detector = ScriptedDetector()
+    tracking = Tracking(model=detector)
+    tracking.yolo_period = 0.4
+
+    try:
+        predict_for(tracking, 1.0)
+    finally:
+        tracking.stop()
+
+    assert 2 <= detector.calls <= 4
+
+
+def test_detection_thread_restarts_after_idle_timeout():
+    detector = ScriptedDetector()
+    tracking = Tracking(model=detector)
+    tracking.yolo_period = 0
+    tracking.idle_timeout = 0.1
+
+    try:
+        predict_for(tracking, 0.2)
+        time.sleep(0.3)
+        calls = detector.calls
+        predict_for(tracking, 0.2)
+    finally:
+        tracking.stop()
+
+    assert detector.calls > calls
+
+
+class SlowDetector(ScriptedDetector):
+    def detect(self, frames, confidence):
+        time.sleep(0.05)
+        return super().detect(frames, confidence)
+
+
+def test_scheduled_latency_includes_the_batched_detection():
+    streams = MultiStreamTracking(model=SlowDetector())
+    streams.add_stream('cam')
+
+    try:
+        streams.predict('cam', FRAME)
+    finally:
+        streams.stop()
+
+    assert streams['cam'].yolo_latency >= 0.05
@@ -0,0 +1,39 @@
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+from VisionForge import TrackLogReader
+from VisionForge.Benchmark import run_benchmark
+
+FIELDS = ['frame', 'detection_frame', 'kind', 'track_id', 'label_id', 'cords', 'euclidean_intensity',
+          'template_matching_conf', 'yolo_conf', 'association']
+
+
+def logged_records(path):
+    return repack_fields(TrackLogReader(path).frames(kind=None)[FIELDS])
+
+
+def test_replay_reproduces_the_logged_records(tmp_path):
+    settings = dict(boxes=10, resolution=(640, 360), frames=60, warmup=5, detector_latency_ms=20, seed=1)
+
+    run_benchmark(track_log=tmp_path / 'live.vflog', **settings)
+    run_benchmark(replay=tmp_path / 'live.vflog', track_log=tmp_path / 'replay.vflog', **settings)
+
+    live, replay = logged_records(tmp_path / 'live.vflog'), logged_records(tmp_path / 'replay.vflog')
+
+    assert len(live)
+    assert np.array_equal(live, replay)
+
+
+def test_appended_runs_continue_the_log(tmp_path):
+    settings = dict(boxes=5, resolution=(640, 360), frames=30, warmup=5, detector_latency_ms=20)
+
+    run_benchmark(track_log=tmp_path / 'log.vflog', seed=0, **settings)
+    first = TrackLogReader(tmp_path / 'log.vflog').frames()
+    run_benchmark(track_log=tmp_path / 'log.vflog', seed=1, **settings)
+
+    log = TrackLogReader(tmp_path / 'log.vflog')
+    second = log.frames(first['frame'][-1] + 1)
+
+    assert np.all(np.diff(log.records['frame']) >= 0)
+    assert np.all(np.diff(log.records['timestamp']) >= 0)
+    assert np.array_equal(log.frames(0, first['frame'][-1] + 1), first)
+    assert second['track_id'].min() > first['track_id'].max()